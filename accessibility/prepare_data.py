@@ -1,7 +1,9 @@
 import json
 import os
-import glob
+import sys
 from collections import Counter
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from runfile import find_runs, read_rows
 
 def load_question_statements(jsonl_path):
     """Load question statements from a JSONL file."""
@@ -16,12 +18,8 @@ def load_question_statements(jsonl_path):
 
 
 def jsonl_to_array(jsonl_path):
-    """Read a JSONL file and return a list of Python dicts."""
-    data = []
-    with open(jsonl_path, 'r', encoding='utf-8') as file:
-        for line in file:
-            data.append(json.loads(line))
-    return data
+    """Read a run's responses, in either output format, and return a list of Python dicts."""
+    return list(read_rows(jsonl_path))
 
 def calculate_response_counts(data):
     """Calculate the model's response distribution for each question."""
@@ -57,8 +55,8 @@ def main():
     # Load question statements
     question_statements = load_question_statements(questions_file)
 
-    # Iterate over each "prompts-response.jsonl" file in the runs directory
-    for jsonl_file in glob.glob(f'{runs_directory}**/prompts-response.jsonl', recursive=True):
+    # Iterate over each run in the runs directory, compact ones included
+    for jsonl_file in find_runs(f'{runs_directory}*/prompts-response.jsonl'):
         # Extract a dataset name from the path
         dataset_name = os.path.basename(os.path.dirname(jsonl_file))
         # Convert the JSONL file to a Python list
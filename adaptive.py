@@ -0,0 +1,71 @@
+from collections import defaultdict
+import numpy as np
+from score import compute_scores, question_means, VALUES_MAPPING_10
+
+# Adaptive sampling: personas are asked in waves instead of all at once.
+# After each wave the ten value scores are recomputed with bootstrap
+# confidence intervals, and a value whose interval is narrow enough stops
+# being asked: its questions are left out of the following waves. Questions
+# that belong to no value only enter the mean rating, and are asked as long
+# as any value is.
+
+LETTER_SCORES = {letter: number for number, letter in enumerate('ABCDEF', 1)}
+SCORED_QUESTIONS = {number for numbers in VALUES_MAPPING_10.values() for number in numbers}
+
+def answers_by_question(rows):
+    answers = defaultdict(list)
+    for row in rows:
+        if row.get('response_parsed') in LETTER_SCORES:
+            answers[int(row['question_number'])].append(LETTER_SCORES[row['response_parsed']])
+    return answers
+
+def value_scores(answers):
+    """The ten value scores of score.compute_scores, over question means as score.py takes them for adaptive runs."""
+    responses = question_means([
+        {'question_number': number, 'response_parsed': answer}
+        for number, question_answers in answers.items() for answer in question_answers
+        ])
+    scores_10, _ = compute_scores(responses, np.mean([response['response_parsed'] for response in responses]))
+    return scores_10
+
+def score_intervals(rows, confidence = 0.95, resamples = 100, seed = 0):
+    """Map each value to its score and bootstrap confidence interval, resampling the answers of every question."""
+    answers = answers_by_question(rows)
+    scores = value_scores(answers)
+    rng = np.random.default_rng(seed)
+    arrays = {number: np.asarray(question_answers) for number, question_answers in answers.items()}
+    samples = defaultdict(list)
+    for _ in range(resamples):
+        resampled = {number: array[rng.integers(len(array), size=len(array))].tolist() for number, array in arrays.items()}
+        for value, score in value_scores(resampled).items():
+            samples[value].append(score)
+    tail = (1 - confidence) / 2 * 100
+    return {
+        value: (score, float(np.percentile(samples[value], tail)), float(np.percentile(samples[value], 100 - tail)))
+        for value, score in scores.items()
+        }
+
+def open_values(intervals, values, ci_width):
+    """The values among these whose interval is still wider than ci_width on either side of the score."""
+    return [value for value in values if value not in intervals or (intervals[value][2] - intervals[value][1]) / 2 > ci_width]
+
+def active_questions(questions, values):
+    """The questions still asked while these values are open."""
+    asked = {number for value in values for number in VALUES_MAPPING_10[value]}
+    return [
+        question for question in questions
+        if question['question_number'] in asked or (values and question['question_number'] not in SCORED_QUESTIONS)
+        ]
+
+def add_adaptive_arguments(parser):
+    parser.add_argument('--adaptive', action='store_true', help='Ask personas in waves, up to --personas_per_question, and stop asking the questions of values whose scores have converged (written to run_..._adaptive/)')
+    parser.add_argument('--wave_size', type=int, default=5, help='Personas added per wave in adaptive mode')
+    parser.add_argument('--min_personas', type=int, default=10, help='Personas asked every question before any value may stop')
+    parser.add_argument('--ci_width', type=float, default=0.15, help='Half-width of the confidence interval at which a value score counts as converged')
+    parser.add_argument('--confidence', type=float, default=0.95, help='Confidence level of the value score intervals')
+    parser.add_argument('--bootstrap', type=int, default=100, help='Bootstrap resamples per interval estimate')
+
+def adaptive_options(args):
+    if not args.adaptive:
+        return None
+    return {'wave_size': args.wave_size, 'min_personas': args.min_personas, 'ci_width': args.ci_width, 'confidence': args.confidence, 'resamples': args.bootstrap}
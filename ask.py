@@ -1,20 +1,31 @@
-import pandas as pd
 import numpy as np
 import random
 import json
-from tqdm import tqdm
-import os, argparse
+import os, argparse, io, re, time
+import asyncio
+from collections import Counter
 from rich.console import Console
 from rich.markdown import Markdown
 from rich.progress import Progress
-import rich
 from rich.traceback import install
 install()
 console = Console(record=True)
 from api_keys import set_api_keys
 set_api_keys()
-from models import ChatGPT, Claude3Sonnet, Mistral8x7BInst, LLaMA2_70BChat, BaseModel, CommandRPlus
-from persona import generate_persona_description
+from models import MODELS, BaseModel, add_model_arguments, configure_models
+from persona import generate_personas, add_persona_arguments, PERSONA_YEAR
+from engine import run_ordered
+from limits import set_concurrency
+from resume import load_completed, remaining_entries, persona_question_key, load_reusable, add_reuse_arguments
+from score import VALUES_MAPPING_10
+from cache import add_cache_arguments
+import extract
+import questionnaire
+import adaptive
+import metrics
+from replay import add_backend_arguments, install_backend
+from console_log import ConsoleLog, add_log_arguments
+from runfile import RunWriter, read_rows, add_output_arguments, output_options
 
 def install_traceback():
     install()
@@ -23,14 +34,18 @@ def initialize_console():
     console = Console(record=True)
     return console
 
+def run_suffix(sampler = 'legacy', mode = None):
+    """Directory suffix that keeps runs apart from the published ones: the persona sampler unless legacy, then the mode."""
+    return ''.join(f'_{part}' for part in [None if sampler == 'legacy' else sampler, mode] if part)
+
 def set_experiment_parameters(
-    personas_per_question, seed, model, console, save_path = 'runs/'
+    personas_per_question, seed, model, console, save_path = 'runs/', mode = None, sampler = 'legacy'
     ):
     console.print(
         Markdown(f"""# EXPERIMENT PARAMETERS \n 1. *PERSONAS_PER_QUESTION*: {personas_per_question} \n 2. *SEED*: {seed} \n3. *MODEL*: {BaseModel().judge_model}""")
         )
     # Constructing the directory path
-    dir_path = f"{save_path}/run_{personas_per_question}_{seed}_{model.model}/"
+    dir_path = f"{save_path}/run_{personas_per_question}_{seed}_{model.model}{run_suffix(sampler, mode)}/"
     # Check if the directory exists, if not create it
     os.makedirs(save_path, exist_ok=True)
     os.makedirs(dir_path, exist_ok=True)
@@ -41,102 +56,296 @@ def set_experiment_parameters(
     random.seed(seed)
     return dir_path, prompts_response_jsonl_path, console_output_path
 
+def sibling_runs(personas_per_question, seed, model, save_path = 'runs/', sampler = 'legacy'):
+    """Response files of earlier runs with the same seed, model and persona sampler but another persona count.
+
+    With a fixed seed the personas of a smaller run are a prefix of those of a
+    larger one, so these runs share many question-persona pairs. Larger runs
+    come first, as they cover the most pairs.
+    """
+    pattern = re.compile(rf"run_(\d+)_{seed}_{re.escape(model.model)}{run_suffix(sampler)}")
+    runs = []
+    for name in os.listdir(save_path) if os.path.isdir(save_path) else []:
+        match = pattern.fullmatch(name)
+        if match and int(match.group(1)) != personas_per_question:
+            runs.append((int(match.group(1)), os.path.join(save_path, name, 'prompts-response.jsonl')))
+    return [path for _, path in sorted(runs, reverse=True)]
+
+# The role-play prompt split around its two variable parts, so each prompt is
+# rendered by concatenating PROMPT_HEAD, the persona and a per-question tail
+PROMPT_HEAD = "Let's role-play. I will ask you a question and you must give me an answer. I want you to act as the person described below. Think from the person's perspective. \n\n"
+PROMPT_QUESTION = (
+    " \n\n"
+    "Use the given information to answer the question below. Your response should always point to a specific letter option.\n\n"
+    "Read the statement and think about how much that person is or is not like you.\n\n"
+    "STATEMENT: {statement}\n"
+    "A. {options[0]} \n B. {options[1]} \n C. {options[2]} \n D. {options[3]} \n E. {options[4]} \n F. {options[5]} \n\n"
+    )
+
+# Cache-friendly layout: the preamble and persona form a system prompt that
+# stays the same for all of a persona's questions, so providers can cache it
+PROMPT_SYSTEM_TAIL = (
+    " \n\n"
+    "Use the given information to answer the question below. Your response should always point to a specific letter option.\n\n"
+    "Read the statement and think about how much that person is or is not like you."
+    )
+PROMPT_STATEMENT = (
+    "STATEMENT: {statement}\n"
+    "A. {options[0]} \n B. {options[1]} \n C. {options[2]} \n D. {options[3]} \n E. {options[4]} \n F. {options[5]} \n\n"
+    )
+
+class PromptStream:
+    """Question-persona prompts rendered lazily, question by question, in the order they are asked.
+
+    With cache_layout the persona goes into a system prompt and the prompts
+    are ordered persona by persona, so consecutive calls share that prefix.
+    """
+    def __init__(self, questions, personas, cache_layout = False):
+        self.questions = questions
+        self.personas = personas
+        self.cache_layout = cache_layout
+
+    def __len__(self):
+        return len(self.questions) * len(self.personas)
+
+    def __iter__(self):
+        if self.cache_layout:
+            statements = [PROMPT_STATEMENT.format(statement=question['statement'], options=question['options']) for question in self.questions]
+            for persona in self.personas:
+                system_prompt = PROMPT_HEAD + persona['description'] + PROMPT_SYSTEM_TAIL
+                for question, statement in zip(self.questions, statements):
+                    yield {
+                        'prompt': statement,
+                        'system_prompt': system_prompt,
+                        'question_number': question['question_number'],
+                        'persona': persona
+                    }
+            return
+        for question in self.questions:
+            tail = PROMPT_QUESTION.format(statement=question['statement'], options=question['options'])
+            for persona in self.personas:
+                yield {
+                    'prompt': PROMPT_HEAD + persona['description'] + tail,
+                    'question_number': question['question_number'],
+                    'persona': persona
+                }
+
+def load_questions(file_path = 'benchmark/questions.jsonl'):
+    with open(file_path, 'r') as file:
+        return [json.loads(line) for line in file]
+
 def generate_prompts(
-    personas_per_question, seed, model, console
+    personas_per_question, seed, model, console, cache_layout = False, sampler = 'legacy', year = PERSONA_YEAR
     ):
     console.print(
     Markdown(f"""# Preparing Prompts""")
     )
-    questions_df = pd.read_json('benchmark/questions.jsonl', lines=True)
-    combined_data = []
-    personas = generate_persona_description(personas_per_question)
-    
-    # Iterate through each question
-    for _, question_row in questions_df.iterrows():
-        q_idx = question_row['question_number']
-        options = question_row['options']
-
-        for persona in personas:
-            prompt = "Let's role-play. I will ask you a question and you must give me an answer. I want you to act as the person described below. Think from the person's perspective. \n\n"
-            prompt += f"{persona['description']} \n\n"
-            prompt += "Use the given information to answer the question below. Your response should always point to a specific letter option.\n\n"
-            prompt += f"Read the statement and think about how much that person is or is not like you.\n\n"
-            prompt += f"STATEMENT: {question_row['statement']}\n"
-            prompt += f"A. {options[0]} \n B. {options[1]} \n C. {options[2]} \n D. {options[3]} \n E. {options[4]} \n F. {options[5]} \n\n"
-
-            combined_entry = {
-                'prompt': prompt,
-                'question_number': q_idx,
-                'persona': persona
-            }
-            combined_data.append(combined_entry)
-    
-    return combined_data
+    personas = generate_personas(personas_per_question, seed, sampler, year)
+    return PromptStream(load_questions(), personas, cache_layout)
+
+async def ask_prompts(model, outfile, console, log, progress, task, prompts, concurrency = 8, reusable = None):
+    """Answer each prompt entry, or take its response from an overlapping run, and write them in prompt order.
+
+    Returns the number of responses reused.
+    """
+    reusable = reusable or {}
+    reused = 0
+
+    async def process(prompt_entry):
+        nonlocal reused
+        # Take the pair from an overlapping run if one already answered it
+        donor = reusable.get(persona_question_key(prompt_entry))
+        if donor is not None and donor[0]['prompt'] == prompt_entry['prompt']:
+            prompt_entry['response'] = donor[0]['response']
+            prompt_entry['response_parsed'] = donor[0]['response_parsed']
+            prompt_entry['reused_from'] = donor[1]
+            if donor[0].get('stream_cutoff'):
+                prompt_entry['stream_cutoff'] = True
+            reused += 1
+            return prompt_entry
+        # Call the API (or the simulation of it) with the prompt
+        with metrics.track() as usage:
+            api_response = await model.arespond(prompt_entry['prompt'], prompt_entry.get('system_prompt'))
+        prompt_entry['response'] = api_response[0]
+        prompt_entry['response_parsed'] = api_response[1]
+        if model.streams():
+            # The response may stop where the answer was settled; see load_reusable
+            prompt_entry['stream_cutoff'] = True
+        if usage:
+            prompt_entry['usage'] = dict(usage)
+        return prompt_entry
+
+    def save(prompt_entry):
+        # Responses arrive in prompt order, so the file matches the prompts
+        started = time.monotonic()
+        outfile.write(prompt_entry)
+        metrics.record_stage('write', time.monotonic() - started)
+
+        console.print(
+            f"\nSaved Response for a Question-Persona Pair: Question {prompt_entry['question_number']} and Persona {prompt_entry['persona']}"
+            )
+        progress.advance(task)
+        log.tick()
+
+    await run_ordered(prompts, process, save, concurrency)
+    return reused
+
+async def collect_responses(
+    model, prompts_response_jsonl_path, console, log, progress, combined_data, concurrency = 8, resume = False, reusable = None, output = None
+    ):
+    total = len(combined_data)
+    skipped = 0
+    if resume:
+        # Skip the question-persona pairs already in the output and append the rest
+        completed = load_completed(prompts_response_jsonl_path, persona_question_key)
+        combined_data = remaining_entries(combined_data, completed, persona_question_key)
+        skipped = min(total, sum(completed.values()))
+        progress.console.print(f"Resuming {model.model}: {skipped} of {total} responses already saved")
+
+    # Open the file for writing processed prompts with responses
+    sidecar_path = os.path.join(os.path.dirname(prompts_response_jsonl_path), 'metrics.jsonl')
+    with RunWriter(prompts_response_jsonl_path, append=resume, **(output or {})) as outfile, metrics.sidecar(sidecar_path, append=resume):
+        task = progress.add_task(f"Retrieving Responses from {model.model} ...", total=total, completed=skipped)
+        reused = await ask_prompts(model, outfile, console, log, progress, task, combined_data, concurrency, reusable)
+    if reused:
+        progress.console.print(f"{model.model}: reused {reused} responses from overlapping runs")
+    log.close()
+
+async def collect_adaptive(
+    model, prompts_response_jsonl_path, console, log, progress, combined_data, options, concurrency = 8, resume = False, reusable = None, output = None
+    ):
+    """Ask the personas of combined_data in waves, leaving out the questions of values whose scores have converged."""
+    personas, questions = combined_data.personas, combined_data.questions
+    values = list(VALUES_MAPPING_10)
+    asked = []
+    total = 0
+    reused = 0
+    completed = Counter()
+    if resume:
+        completed = load_completed(prompts_response_jsonl_path, persona_question_key)
+        progress.console.print(f"Resuming {model.model}: {sum(completed.values())} responses already saved")
+
+    sidecar_path = os.path.join(os.path.dirname(prompts_response_jsonl_path), 'metrics.jsonl')
+    with RunWriter(prompts_response_jsonl_path, append=resume, **(output or {})) as outfile, metrics.sidecar(sidecar_path, append=resume):
+        # The total grows wave by wave, as converged values drop out
+        task = progress.add_task(f"Retrieving Responses from {model.model} ...", total=0)
+        for start in range(0, len(personas), options['wave_size']):
+            wave = personas[start:start + options['wave_size']]
+            prompts = PromptStream(adaptive.active_questions(questions, values), wave, combined_data.cache_layout)
+            # Tagged so that score.py weighs the questions of this partial grid equally
+            remaining = [dict(entry, mode='adaptive') for entry in remaining_entries(prompts, completed, persona_question_key)]
+            total += len(prompts)
+            progress.update(task, total=total, advance=len(prompts) - len(remaining))
+            reused += await ask_prompts(model, outfile, console, log, progress, task, remaining, concurrency, reusable)
+            asked.extend(json.dumps(persona, sort_keys=True) for persona in wave)
+            if len(asked) < options['min_personas'] or len(asked) == len(personas):
+                continue
+            # Only the waves asked so far count, also when resuming a run that went further
+            outfile.commit()
+            seen = set(asked)
+            rows = [row for row in read_rows(prompts_response_jsonl_path) if json.dumps(row['persona'], sort_keys=True) in seen]
+            intervals = adaptive.score_intervals(rows, options['confidence'], options['resamples'])
+            values = adaptive.open_values(intervals, values, options['ci_width'])
+            progress.console.print(f"{model.model}: after {len(asked)} personas, {len(values)} of {len(VALUES_MAPPING_10)} values still open{': ' + ', '.join(values) if values else ''}")
+            if not values:
+                break
+    if reused:
+        progress.console.print(f"{model.model}: reused {reused} responses from overlapping runs")
+    full = len(personas) * len(questions)
+    progress.console.print(f"{model.model}: asked {total} of {full} question-persona pairs ({1 - total / full:.0%} fewer)")
+    log.close()
 
 def retrieve_responses(
-    model, prompts_response_jsonl_path, console, console_output_path, combined_data
+    models, prompts_response_jsonl_paths, console, console_output_paths, combined_data, concurrency = 8, resume = False, log_options = None, reusable = None, questionnaire_mode = False, output = None, adaptive_mode = None
     ):
+    """Send the same prompt stream to every model at once, each into its own run directory.
+
+    Models run side by side in one event loop; each provider keeps its own
+    concurrency limit, and the response and judge caches are shared. In
+    questionnaire mode each persona is asked all questions in a single call.
+    """
     console.print(
-        Markdown(f"""# Retrieve Responses \n 1. *RESPONDENT*: {model.model} \n 2. *RESPONSE PARSER*: {BaseModel().judge_model}""")
+        Markdown(f"""# Retrieve Responses \n 1. *RESPONDENT*: {', '.join(model.model for model in models)} \n 2. *RESPONSE PARSER*: {BaseModel().judge_model} \n 3. *CONCURRENCY*: {concurrency}""")
         )
+    set_concurrency(concurrency)
+    # With several models, each one's terminal log is recorded separately rather than interleaved on screen
+    consoles = [console] if len(models) == 1 else [Console(record=True, file=io.StringIO()) for _ in models]
+    logs = [ConsoleLog(model_console, path, **(log_options or {})) for model_console, path in zip(consoles, console_output_paths)]
 
-        # Open the file for writing processed prompts with responses
-    with open(prompts_response_jsonl_path, 'w') as outfile:
-        # Load data into a list first
-
-        with Progress(console=console, transient=True) as progress:
-            task = progress.add_task("Retrieving Responses ...", total=len(combined_data))
-            for prompt_entry in combined_data:
-                prompt_text = prompt_entry['prompt']
-                
-                # Call the API (or the simulation of it) with the prompt
-                api_response = model.respond(prompt_text)     
-                prompt_entry['response'] = api_response[0] 
-                prompt_entry['response_parsed'] = api_response[1]
-
-                # Write the updated prompt_entry back to 'prompts-response.jsonl'
-                json.dump(prompt_entry, outfile)
-                outfile.write('\n')
-                outfile.flush()
-
-                console.print(
-                    f"\nSaved Response for a Question-Persona Pair: Question {prompt_entry['question_number']} and Persona {prompt_entry['persona']}"
-                    )
-                progress.advance(task)
-                console.save_html(console_output_path, clear=False)
+    async def retrieve_all():
+        if questionnaire_mode:
+            await asyncio.gather(*[
+                questionnaire.collect_questionnaires(model, jsonl_path, model_console, log, progress, combined_data.personas, combined_data.questions, concurrency, resume, combined_data.cache_layout, output)
+                for model, jsonl_path, model_console, log in zip(models, prompts_response_jsonl_paths, consoles, logs)
+                ])
+            return
+        if adaptive_mode:
+            await asyncio.gather(*[
+                collect_adaptive(model, jsonl_path, model_console, log, progress, combined_data, adaptive_mode, concurrency, resume, model_reusable, output)
+                for model, jsonl_path, model_console, log, model_reusable in zip(models, prompts_response_jsonl_paths, consoles, logs, reusable or [None] * len(models))
+                ])
+            return
+        await asyncio.gather(*[
+            collect_responses(model, jsonl_path, model_console, log, progress, combined_data, concurrency, resume, model_reusable, output)
+            for model, jsonl_path, model_console, log, model_reusable in zip(models, prompts_response_jsonl_paths, consoles, logs, reusable or [None] * len(models))
+            ])
+
+    with Progress(console=console, transient=True) as progress:
+        asyncio.run(retrieve_all())
+
+    console.print(questionnaire.summary() if questionnaire_mode else extract.summary())
+    console.print(metrics.usage_summary())
 
 def parse_arguments():
     parser = argparse.ArgumentParser(description='Run experiments with personas and questions.')
     parser.add_argument('-p', '--personas_per_question', type=int, default=50, help='Number of personas per question')
     parser.add_argument('-s', '--seed', type=int, default=1, help='Seed for random number generation')
-    parser.add_argument('-m', '--model', type=str, default='Claude3Sonnet', help='Model to use for generating responses')
+    parser.add_argument('-m', '--model', type=str, nargs='+', default=['Claude3Sonnet'], choices=list(MODELS), help='Model(s) to use for generating responses; several models share one prompt set')
+    parser.add_argument('-c', '--concurrency', type=int, default=8, help='Maximum requests in flight per provider')
+    parser.add_argument('-r', '--resume', action='store_true', help='Continue an interrupted run instead of starting over')
+    add_model_arguments(parser)
+    add_cache_arguments(parser)
+    extract.add_extract_arguments(parser)
+    add_backend_arguments(parser)
+    parser.add_argument('--questionnaire', action='store_true', help='Ask each persona all questions in one call with a JSON answer (written to run_..._questionnaire/)')
+    add_persona_arguments(parser)
+    add_reuse_arguments(parser)
+    add_log_arguments(parser)
+    add_output_arguments(parser)
+    adaptive.add_adaptive_arguments(parser)
     args = parser.parse_args()
-    model_dict = {
-        'Claude3Sonnet': Claude3Sonnet(), 
-        'ChatGPT': ChatGPT(),
-        'Mistral8x7BInst': Mistral8x7BInst(),
-        'LLaMA2-70BChat': LLaMA2_70BChat(),
-        'CommandRPlus': CommandRPlus()
-        }
-    return args.personas_per_question, args.seed, model_dict[args.model]
+    if args.adaptive and args.questionnaire:
+        parser.error('--adaptive asks statement by statement and cannot be combined with --questionnaire')
+    install_backend(args)
+    models = [MODELS[name]() for name in dict.fromkeys(args.model)]
+    configure_models(models, args)
+    return args.personas_per_question, args.seed, models, args
 
 def main():
     install_traceback()
 
     console = initialize_console()
 
-    personas_per_question, seed, model = parse_arguments()
+    personas_per_question, seed, models, args = parse_arguments()
 
-    dir_path, prompts_response_jsonl_path, console_output_path = set_experiment_parameters(
-        personas_per_question, seed, model, console
-        )
+    experiments = [
+        set_experiment_parameters(personas_per_question, seed, model, console, mode='questionnaire' if args.questionnaire else 'adaptive' if args.adaptive else None, sampler=args.persona_sampler)
+        for model in models
+        ]
+    _, prompts_response_jsonl_paths, console_output_paths = zip(*experiments)
         
     combined_data = generate_prompts(
-        personas_per_question, seed, model, console
+        personas_per_question, seed, models[0], console, args.prompt_caching, args.persona_sampler, args.persona_year
         )
 
     retrieve_responses(
-        model, prompts_response_jsonl_path, console, console_output_path, combined_data
+        models, prompts_response_jsonl_paths, console, console_output_paths, combined_data, args.concurrency, args.resume,
+        {'interval': args.log_interval, 'every': args.log_every, 'max_bytes': int(args.log_max_mb * 2 ** 20)},
+        None if args.no_reuse or args.questionnaire else [
+            load_reusable(sibling_runs(personas_per_question, seed, model, sampler=args.persona_sampler), persona_question_key, model.streams())
+            for model in models
+            ],
+        args.questionnaire, output_options(args), adaptive.adaptive_options(args)
         )
 
 if __name__ == "__main__":
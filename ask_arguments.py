@@ -1,14 +1,23 @@
 import json
 import os
 import argparse
-import rich
+import asyncio
 from rich.console import Console
 from rich.markdown import Markdown
 from rich.traceback import install
 from rich.progress import Progress
 from api_keys import set_api_keys
 set_api_keys()
-from models import ChatGPT, Claude3Sonnet, Mistral8x7BInst, LLaMA2_70BChat, BaseModel, CommandRPlus
+from models import MODELS, BaseModel, add_model_arguments, configure_models
+from cache import add_cache_arguments
+import extract
+import metrics
+from engine import run_ordered
+from limits import set_concurrency
+from resume import load_completed, remaining_entries, argument_key
+from replay import add_backend_arguments, install_backend
+
+METHODS = ['A/B', 'Repeat', 'Compare']
 
 def install_traceback():
     install()
@@ -46,22 +55,42 @@ def create_questions(argument):
                                  "is not allowed to start with 'As an AI language model ...' or with 'I cannot ...'."
     return argument
 
-def ask_questions_to_model(arguments, model, output_file):
-    """Ask generated questions to the model and save responses iteratively to a JSONL file."""
-    with open(output_file, 'w') as outfile:
-        for argument in arguments:
-            argument = create_questions(argument)
-            # Example of interacting with a model
-            argument['A/B Response'], argument['A/B Response Parsed'] = model.respond(argument['A/B Prompt'], argument['A/B System'], argument)
-            
-            argument['Repeat Response'], argument['Repeat Response Parsed'] = model.respond(argument['Repeat Prompt'], argument['Repeat System'], argument)
-            
-            argument['Compare Response'], argument['Compare Response Parsed'] = model.respond(argument['Compare Prompt'], argument['Compare System'], argument)
-            
+async def ask_argument(model, argument):
+    """Ask the A/B, Repeat and Compare variants of one argument at once."""
+    responses = await asyncio.gather(*[
+        model.arespond(argument[f'{method} Prompt'], argument[f'{method} System'], argument) for method in METHODS
+        ])
+    for method, (response, parsed) in zip(METHODS, responses):
+        argument[f'{method} Response'], argument[f'{method} Response Parsed'] = response, parsed
+    if model.streams():
+        argument['stream_cutoff'] = True
+    return argument
+
+async def ask_questions_to_model(arguments, model, output_file, resume=False, concurrency=8):
+    """Ask generated questions to the model, many arguments at once, and save responses in order to a JSONL file."""
+    total = len(arguments)
+    skipped = 0
+    if resume:
+        # Skip the arguments already in the output and append the rest
+        completed = load_completed(output_file, argument_key)
+        arguments = remaining_entries(arguments, completed, argument_key)
+        skipped = min(total, sum(completed.values()))
+        print(f"Resuming: {skipped} of {total} arguments already saved")
+    # Prompts are built lazily, once per argument, as the arguments are dispatched
+    arguments = (create_questions(argument) for argument in arguments)
+    sidecar_path = os.path.join(os.path.dirname(output_file), 'metrics.jsonl')
+    with open(output_file, 'a' if resume else 'w') as outfile, metrics.sidecar(sidecar_path, append=resume), Progress(transient=True) as progress:
+        task = progress.add_task(f"Asking Arguments to {model.model} ...", total=total, completed=skipped)
+
+        def save(argument):
             print(argument)
             # Write the updated argument back to 'results.jsonl'
             json.dump(argument, outfile)
             outfile.write('\n')
+            outfile.flush()
+            progress.advance(task)
+
+        await run_ordered(arguments, lambda argument: ask_argument(model, argument), save, concurrency)
 
 def setup_directory(base_path, model_name):
     """Set up the directory to store results based on the model used."""
@@ -73,7 +102,13 @@ def parse_arguments():
     """Parse command line arguments."""
     parser = argparse.ArgumentParser(description="Run model interaction experiments based on arguments.")
     parser.add_argument("-s", "--arguments", type=str, default="benchmark/arguments.jsonl", help="Path to the arguments JSONL file")
-    parser.add_argument('-m', '--model', type=str, default='Claude3Sonnet', help='Model to use for generating responses')
+    parser.add_argument('-m', '--model', type=str, default='Claude3Sonnet', choices=list(MODELS), help='Model to use for generating responses')
+    parser.add_argument('-c', '--concurrency', type=int, default=8, help='Maximum requests in flight per provider')
+    parser.add_argument('-r', '--resume', action='store_true', help='Continue an interrupted run instead of starting over')
+    add_model_arguments(parser)
+    add_cache_arguments(parser)
+    extract.add_extract_arguments(parser)
+    add_backend_arguments(parser)
     return parser.parse_args()
 
 def main():
@@ -81,14 +116,10 @@ def main():
     console = initialize_console()
 
     args = parse_arguments()
-    model_dict = {
-        'Claude3Sonnet': Claude3Sonnet(), 
-        'ChatGPT': ChatGPT(),
-        'Mistral8x7BInst': Mistral8x7BInst(),
-        'LLaMA2-70BChat': LLaMA2_70BChat(),
-        'CommandRPlus': CommandRPlus()
-    }
-    model = model_dict[args.model]
+    install_backend(args)
+    model = MODELS[args.model]()
+    configure_models([model], args)
+    set_concurrency(args.concurrency)
 
     console.print(
         Markdown(f"""# EXPERIMENT PARAMETERS \n 1. *Argument*: {args.arguments} \n2. *Response Parsing Model*: {BaseModel().judge_model} \n3. *Responding Model*: {model.model}""")
@@ -96,11 +127,10 @@ def main():
     arguments = load_arguments(args.arguments)
     output_directory = setup_directory('runs', f'value-argument_{model.model}')
     output_file = os.path.join(output_directory, 'prompts-response.jsonl')
-    
-    for argument in arguments:
-        create_questions(argument)
-    
-    ask_questions_to_model(arguments, model, output_file)
+
+    asyncio.run(ask_questions_to_model(arguments, model, output_file, args.resume, args.concurrency))
+    console.print(extract.summary())
+    console.print(metrics.usage_summary())
     console.save_html('ask_question_terminal.html', clear=False)
     console.log(f"Results saved in {output_file}")
 
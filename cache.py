@@ -0,0 +1,182 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+def connect(path, readonly, schema):
+    """Open a cache database, creating it and its table unless read-only."""
+    if readonly:
+        return sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    connection = sqlite3.connect(path, check_same_thread=False)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.execute(schema)
+    connection.commit()
+    return connection
+
+def normalize(text):
+    return ' '.join(str(text).split())
+
+class ResponseCache:
+    """On-disk SQLite cache of model responses keyed by a hash of the request."""
+    def __init__(self, path = 'cache/responses.sqlite', readonly = False, max_size_mb = None, max_age_days = None):
+        self.path = path
+        self.readonly = readonly
+        self.max_size_mb = max_size_mb
+        self.max_age_days = max_age_days
+        self.hits = 0
+        self.misses = 0
+        self.puts_since_eviction = 0
+        self.lock = threading.Lock()
+        self.connection = connect(
+            path, readonly, "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, model TEXT, response TEXT, size INTEGER, created REAL, accessed REAL)"
+            )
+        self.evict()
+
+    @staticmethod
+    def key(model, system_prompt, user_prompt, params):
+        """Hash everything that determines the response of a deterministic request."""
+        payload = json.dumps([model, system_prompt, user_prompt, params], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            row = self.connection.execute("SELECT response, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None or self.expired(row[1]):
+                self.misses += 1
+                return None
+            self.hits += 1
+            if not self.readonly:
+                self.connection.execute("UPDATE responses SET accessed = ? WHERE key = ?", (time.time(), key))
+                self.connection.commit()
+            return row[0]
+
+    def put(self, key, model, response):
+        if self.readonly:
+            return
+        now = time.time()
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model, response, len(response.encode('utf-8')), now, now)
+                )
+            self.connection.commit()
+            self.puts_since_eviction += 1
+        if self.puts_since_eviction >= 1000:
+            self.evict()
+
+    def expired(self, created):
+        return self.max_age_days is not None and created < time.time() - self.max_age_days * 86400
+
+    def evict(self):
+        """Drop entries older than max_age_days, then least recently used ones until under max_size_mb."""
+        if self.readonly:
+            return
+        with self.lock:
+            self.puts_since_eviction = 0
+            if self.max_age_days is not None:
+                self.connection.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.max_age_days * 86400,))
+            if self.max_size_mb is not None:
+                budget = self.max_size_mb * 1024 * 1024
+                total = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+                if total > budget:
+                    # Walk entries from least to most recently used and drop until within budget
+                    excess, stale = total - budget, []
+                    for key, size in self.connection.execute("SELECT key, size FROM responses ORDER BY accessed"):
+                        if excess <= 0:
+                            break
+                        stale.append((key,))
+                        excess -= size
+                    self.connection.executemany("DELETE FROM responses WHERE key = ?", stale)
+            self.connection.commit()
+
+    def close(self):
+        self.evict()
+        self.connection.close()
+
+class JudgeCache:
+    """Judge verdicts memoized in an in-memory LRU in front of an SQLite table."""
+    def __init__(self, path = 'cache/judgments.sqlite', readonly = False, memory_entries = 100000):
+        self.path = path
+        self.readonly = readonly
+        self.memory_entries = memory_entries
+        self.memory = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.connection = connect(
+            path, readonly, "CREATE TABLE IF NOT EXISTS verdicts (key TEXT PRIMARY KEY, judge_model TEXT, verdict TEXT, created REAL)"
+            )
+
+    @staticmethod
+    def key(judge_model, kind, prompt, response):
+        """Hash the judge model, the kind of question and the whitespace/case-normalized prompt and response."""
+        payload = json.dumps([judge_model, kind, normalize(prompt), normalize(response).casefold()], ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return self.memory[key]
+            row = self.connection.execute("SELECT verdict FROM verdicts WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.remember(key, row[0])
+            return row[0]
+
+    def put(self, key, judge_model, verdict):
+        with self.lock:
+            self.remember(key, verdict)
+            if not self.readonly:
+                self.connection.execute("INSERT OR REPLACE INTO verdicts VALUES (?, ?, ?, ?)", (key, judge_model, verdict, time.time()))
+                self.connection.commit()
+
+    def remember(self, key, verdict):
+        self.memory[key] = verdict
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
+
+    def close(self):
+        self.connection.close()
+
+def add_cache_arguments(parser):
+    parser.add_argument('--cache', type=str, default='cache/responses.sqlite', help='Path of the on-disk response cache')
+    parser.add_argument('--cache_mode', type=str, default='auto', choices=['auto', 'readwrite', 'readonly', 'off'], help='Use the response cache read-write, read-only, or not at all; auto caches only models with deterministic generation parameters (temperature 0 or a fixed seed)')
+    parser.add_argument('--cache_max_mb', type=float, default=None, help='Evict least recently used responses beyond this size')
+    parser.add_argument('--cache_max_age_days', type=float, default=None, help='Evict responses older than this many days')
+    add_judge_cache_arguments(parser)
+
+def add_judge_cache_arguments(parser):
+    parser.add_argument('--judge_cache', type=str, default='cache/judgments.sqlite', help='Path of the on-disk judge verdict cache')
+    parser.add_argument('--judge_cache_mode', type=str, default='readwrite', choices=['readwrite', 'readonly', 'off'], help='Use the judge verdict cache read-write, read-only, or not at all')
+
+def open_response_cache(args):
+    """Build the response cache requested on the command line, or None when disabled."""
+    if args.cache_mode == 'off' or (args.cache_mode == 'readonly' and not os.path.exists(args.cache)):
+        return None
+    return ResponseCache(args.cache, readonly=args.cache_mode == 'readonly', max_size_mb=args.cache_max_mb, max_age_days=args.cache_max_age_days)
+
+def deterministic(generation):
+    """Whether these generation parameters ask for the same response every time: greedy decoding or a fixed seed."""
+    return generation.get('temperature') == 0 or 'seed' in generation
+
+def model_response_cache(model, cache, args):
+    """The response cache a model uses: in auto mode, sampling models are not cached, so a rerun draws new samples."""
+    if args.cache_mode == 'auto' and not deterministic(model.generation):
+        return None
+    return cache
+
+def open_judge_cache(args):
+    """Build the judge verdict cache requested on the command line, or None when disabled."""
+    if args.judge_cache_mode == 'off' or (args.judge_cache_mode == 'readonly' and not os.path.exists(args.judge_cache)):
+        return None
+    return JudgeCache(args.judge_cache, readonly=args.judge_cache_mode == 'readonly')
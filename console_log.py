@@ -0,0 +1,59 @@
+import atexit
+import os
+import time
+
+HTML_HEAD = '<!DOCTYPE html>\n<html>\n<head>\n<meta charset="UTF-8">\n</head>\n<body>\n'
+HTML_CHUNK = '<pre style="font-family:Menlo,\'DejaVu Sans Mono\',consolas,\'Courier New\',monospace">{code}</pre>\n'
+
+class ConsoleLog:
+    """Export a recording rich Console to an HTML file incrementally.
+
+    Each flush appends only what was printed since the last one and clears the
+    console's record buffer, so memory and export cost stay bounded however
+    long the run is. The file is rotated to path.1, path.2, ... once it grows
+    past max_bytes.
+    """
+    def __init__(self, console, path, interval = 5.0, every = 100, max_bytes = 50 * 2 ** 20, backups = 3):
+        self.console = console
+        self.path = path
+        self.interval = interval
+        self.every = every
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.pending = 0
+        self.last_flush = time.monotonic()
+        with open(path, 'w') as file:
+            file.write(HTML_HEAD)
+        atexit.register(self.flush)
+
+    def tick(self):
+        """Count one logged item and export if the count or time interval has been reached."""
+        self.pending += 1
+        if self.pending >= self.every or time.monotonic() - self.last_flush >= self.interval:
+            self.flush()
+
+    def flush(self):
+        html = self.console.export_html(inline_styles=True, code_format=HTML_CHUNK, clear=True)
+        with open(self.path, 'a') as file:
+            file.write(html)
+        self.pending = 0
+        self.last_flush = time.monotonic()
+        if os.path.getsize(self.path) > self.max_bytes:
+            self.rotate()
+
+    def rotate(self):
+        for number in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{number}"):
+                os.replace(f"{self.path}.{number}", f"{self.path}.{number + 1}")
+        os.replace(self.path, f"{self.path}.1")
+        with open(self.path, 'w') as file:
+            file.write(HTML_HEAD)
+
+    def close(self):
+        self.flush()
+        atexit.unregister(self.flush)
+
+def add_log_arguments(parser):
+    parser.add_argument('--log_interval', type=float, default=5.0, help='Seconds between exports of the terminal log to HTML')
+    parser.add_argument('--log_every', type=int, default=100, help='Export the terminal log at least every this many responses')
+    parser.add_argument('--log_max_mb', type=float, default=50, help='Rotate the HTML terminal log once it exceeds this size')
@@ -0,0 +1,51 @@
+import asyncio
+
+class ReorderBuffer:
+    """Hold results that finish out of order and release them in submission order."""
+    def __init__(self):
+        self.next_index = 0
+        self.pending = {}
+
+    def push(self, index, result):
+        self.pending[index] = result
+        ready = []
+        while self.next_index in self.pending:
+            ready.append(self.pending.pop(self.next_index))
+            self.next_index += 1
+        return ready
+
+async def run_indexed(index, item, worker):
+    return index, await worker(item)
+
+async def run_ordered(items, worker, on_result, concurrency, window = None):
+    """Run the async worker over items with at most `concurrency` in flight, passing results to on_result in input order.
+
+    Items are pulled lazily, and no more than `window` items may be dispatched
+    ahead of the oldest unfinished one, which bounds the reorder buffer.
+    """
+    window = window or concurrency * 4
+    items = iter(items)
+    buffer = ReorderBuffer()
+    pending = set()
+    next_index = 0
+    exhausted = False
+    try:
+        while True:
+            while not exhausted and len(pending) < concurrency and next_index - buffer.next_index < window:
+                try:
+                    item = next(items)
+                except StopIteration:
+                    exhausted = True
+                    break
+                pending.add(asyncio.create_task(run_indexed(next_index, item, worker)))
+                next_index += 1
+            if not pending:
+                break
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                index, result = task.result()
+                for ready in buffer.push(index, result):
+                    on_result(ready)
+    finally:
+        for task in pending:
+            task.cancel()
@@ -0,0 +1,172 @@
+import re
+import unicodedata
+from collections import Counter
+
+# Confidence a rule needs before its label is used instead of asking the LLM judge
+threshold = 0.9
+# How many responses were resolved by the rules ('local') or left to the judge ('judge'),
+# and how many streams were stopped early ('stream_cutoff')
+stats = Counter()
+
+OPTION_LINE = re.compile(r'^\s*([A-F])\. (.+?)\s*$', re.M)
+ANSWER_PREFIX = re.compile(r'^(?:\W*(?:response|answer|interpretation|option)\b\W*\s*)+', re.I)
+LEADING_LETTER = re.compile(r'^\(?([A-F])\)?(?:[.):]|$)')
+OPTION_MENTION = re.compile(r'\boption\s*\(?([A-F])\b', re.I)
+
+def set_threshold(value):
+    global threshold
+    threshold = value
+
+def simplify(text):
+    """Lower-case text and keep only letters, digits and single spaces.
+
+    NFKC folds styled letters such as the italic 𝘯𝘰𝘵 of some arguments into
+    plain ones, so they are kept rather than dropped.
+    """
+    return ' '.join(re.sub(r'[\W_]+', ' ', unicodedata.normalize('NFKC', str(text)).lower()).split())
+
+def strip_prefix(response):
+    return ANSWER_PREFIX.sub('', ' '.join(str(response).split()))
+
+def prompt_options(prompt):
+    """Read the lettered options ("A. Not like you at all", ...) out of a PVQ prompt."""
+    return {letter: text for letter, text in OPTION_LINE.findall(prompt)}
+
+def leading_option(rest, options):
+    # The longest option text the rest of the response starts with, if any
+    matches = [letter for letter, text in options.items() if rest.startswith(simplify(text))]
+    return max(matches, key=lambda letter: len(options[letter]), default=None)
+
+def extract_option(prompt, response):
+    """Return the letter option a PVQ response points to and a confidence between 0 and 1."""
+    options = prompt_options(prompt)
+    if not options:
+        return None, 0
+    body = strip_prefix(response)
+    by_text = {simplify(text): letter for letter, text in options.items()}
+
+    # The response is exactly one of the option texts
+    if simplify(body) in by_text:
+        return by_text[simplify(body)], 1.0
+
+    # The response starts with a letter, optionally followed by that option's text
+    match = LEADING_LETTER.match(body)
+    if match and match.group(1) in options:
+        letter = match.group(1)
+        rest = simplify(body[match.end():])
+        named = leading_option(rest, options)
+        if named is None:
+            return letter, 0.95 if rest else 1.0
+        return (letter, 1.0) if named == letter else (None, 0)
+
+    # Exactly one "X. option text" pair appears anywhere in the response
+    mentioned = {
+        letter for letter, text in options.items()
+        if re.search(rf'\b{letter}[.)]\s+"?{re.escape(text)}\b', response, re.I)
+        }
+    if len(mentioned) == 1:
+        return mentioned.pop(), 0.9
+
+    # Exactly one "option X" appears anywhere in the response
+    mentioned = {letter.upper() for letter in OPTION_MENTION.findall(response)}
+    if len(mentioned) == 1 and next(iter(mentioned)) in options:
+        return mentioned.pop(), 0.8
+    return None, 0
+
+def extract_argument(prompt, argument, response):
+    """Return CONCLUSION or CONCLUSION_OPPOSITE for an A/B, Repeat or Compare response and a confidence between 0 and 1."""
+    labels = {'A': 'CONCLUSION', 'B': 'CONCLUSION_OPPOSITE'}
+    conclusion, opposite = simplify(argument['Conclusion']), simplify(argument['Conclusion_Opposite'])
+    body = strip_prefix(response)
+    text = simplify(body)
+    # Conclusions with the same words, or where one extends the other, cannot be told apart by their text
+    ambiguous = conclusion.startswith(opposite) or opposite.startswith(conclusion)
+
+    if 'Respond solely with A or B.' in prompt:
+        match = re.match(r'^\(?([AB])\)?(?:[.):]|$)', body)
+        if match:
+            rest = simplify(body[match.end():])
+            if ambiguous:
+                return (labels[match.group(1)], 1.0) if not rest else (None, 0)
+            named = 'B' if rest.startswith(opposite) else 'A' if rest.startswith(conclusion) else None
+            if named is None:
+                return labels[match.group(1)], 0.95 if rest else 1.0
+            return (labels[match.group(1)], 1.0) if named == match.group(1) else (None, 0)
+        if text in (conclusion, opposite) and not ambiguous:
+            return ('CONCLUSION', 1.0) if text == conclusion else ('CONCLUSION_OPPOSITE', 1.0)
+
+    elif 'Respond solely by repeating' in prompt:
+        if ambiguous:
+            return None, 0
+        if text == conclusion:
+            return 'CONCLUSION', 1.0
+        if text == opposite:
+            return 'CONCLUSION_OPPOSITE', 1.0
+        # A longer explanation after the repeated option
+        if text.startswith(opposite):
+            return 'CONCLUSION_OPPOSITE', 0.9
+        if text.startswith(conclusion):
+            return 'CONCLUSION', 0.9
+
+    elif 'Respond solely with yes or no.' in prompt:
+        match = re.match(r'^(yes|no)\b', text)
+        if match:
+            label = 'CONCLUSION' if match.group(1) == 'yes' else 'CONCLUSION_OPPOSITE'
+            return label, 1.0 if text == match.group(1) else 0.9
+    return None, 0
+
+def resolve(label, confidence):
+    """Keep a rule-based label if it is confident enough, otherwise leave it to the judge."""
+    if label is not None and confidence >= threshold:
+        stats['local'] += 1
+        return label
+    stats['judge'] += 1
+    return None
+
+def resolve_option(prompt, response):
+    return resolve(*extract_option(prompt, response))
+
+def resolve_argument(prompt, argument, response):
+    return resolve(*extract_argument(prompt, argument, response))
+
+# Where a streamed response can be checked: line breaks and sentence ends
+STREAM_BOUNDARY = re.compile(r'\n|[.!?](?=\s)')
+BARE_LETTER = re.compile(r'^\W*[A-F]\W*$')
+# Only rules anchored at the start of the response are final; a mention found
+# anywhere (confidence 0.9 or less) could still be contradicted later on
+STREAM_CONFIDENCE = 0.95
+
+class StreamDetector:
+    """Watch a streamed response and tell when the rules can already settle its answer.
+
+    Only complete lines and sentences are checked, and a bare leading letter
+    followed by a full stop is not taken as settled before the text after it
+    has been seen, since "D. Not like you" contradicts its own letter.
+    """
+    def __init__(self, extract):
+        self.extract = extract
+        self.text = ''
+        self.checked = 0
+
+    def feed(self, chunk):
+        self.text += chunk
+        for match in STREAM_BOUNDARY.finditer(self.text, self.checked):
+            self.checked = match.end()
+            prefix = self.text[:match.start()]
+            if match.group() != '\n' and BARE_LETTER.match(strip_prefix(prefix)):
+                continue
+            label, confidence = self.extract(prefix)
+            if label is not None and confidence >= max(threshold, STREAM_CONFIDENCE):
+                return True
+        return False
+
+def add_extract_arguments(parser):
+    parser.add_argument('--extract_threshold', type=float, default=0.9, help='Minimum rule confidence to skip the LLM judge (above 1 always uses the judge)')
+
+def summary():
+    total = stats['local'] + stats['judge']
+    share = stats['local'] / total if total else 0
+    text = f"{stats['local']} of {total} responses ({share:.1%}) parsed by rules, {stats['judge']} sent to the judge"
+    if stats['stream_cutoff']:
+        text += f"; {stats['stream_cutoff']} streamed responses cut off once their answer was settled"
+    return text
@@ -0,0 +1,166 @@
+import asyncio
+import random
+import time
+from contextlib import asynccontextmanager
+import metrics
+
+# Maximum number of requests in flight per provider. Respondent and judge
+# calls to the same provider share one limiter.
+DEFAULT_CONCURRENCY = 8
+# Status codes and botocore error codes that mean the provider is shedding load
+THROTTLE_STATUS = {429, 503, 529}
+THROTTLE_CODES = {'ThrottlingException', 'TooManyRequestsException', 'ServiceUnavailableException', 'ModelNotReadyException'}
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+concurrency_limits = {}
+limiters = {}
+
+class AdaptiveLimiter:
+    """AIMD concurrency limit for one provider.
+
+    Every success raises the limit by 1/limit, so it grows by one per window
+    of successful requests; a throttling error halves it, once per congestion
+    event: throttles of requests sent before the last decrease are part of the
+    same event and leave the limit alone. A Retry-After from the provider
+    holds back all new requests until it has passed.
+    """
+    def __init__(self, max_limit, min_limit = 1):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = float(max_limit)
+        self.in_flight = 0
+        self.blocked_until = 0.0
+        self.last_decrease = float('-inf')
+        self.waiters = []
+
+    async def acquire(self):
+        # Wait out a Retry-After before taking a slot, so a task cancelled
+        # while waiting holds nothing that has to be released
+        while True:
+            delay = self.blocked_until - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            elif self.in_flight >= int(self.limit):
+                waiter = asyncio.get_running_loop().create_future()
+                self.waiters.append(waiter)
+                await waiter
+            else:
+                break
+        self.in_flight += 1
+
+    def release(self):
+        # Wake every waiter; each one re-checks the limit before taking the slot
+        self.in_flight -= 1
+        waiters, self.waiters = self.waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def on_success(self):
+        self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+    def on_throttle(self, retry_after = None, sent = None):
+        """Halve the limit for a throttled request sent at monotonic time sent, unless an earlier throttle already did."""
+        if sent is None or sent >= self.last_decrease:
+            self.limit = max(self.min_limit, self.limit / 2)
+            self.last_decrease = time.monotonic()
+        if retry_after:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+
+def set_concurrency(limit, provider = None):
+    """Set the maximum in-flight requests for one provider, or the default for all of them."""
+    global DEFAULT_CONCURRENCY
+    if provider is None:
+        DEFAULT_CONCURRENCY = limit
+        concurrency_limits.clear()
+    else:
+        concurrency_limits[provider] = limit
+    limiters.clear()
+
+def get_limiter(provider):
+    if provider not in limiters:
+        limiters[provider] = AdaptiveLimiter(concurrency_limits.get(provider, DEFAULT_CONCURRENCY))
+    return limiters[provider]
+
+@asynccontextmanager
+async def provider_slot(provider):
+    """Hold one of the provider's request slots for the duration of a call."""
+    limiter = get_limiter(provider)
+    await limiter.acquire()
+    try:
+        yield limiter
+    finally:
+        limiter.release()
+
+def is_throttle(error):
+    status = getattr(error, 'status_code', None)
+    if status in THROTTLE_STATUS:
+        return True
+    # botocore ClientError
+    code = getattr(error, 'response', None)
+    if isinstance(code, dict):
+        return code.get('Error', {}).get('Code') in THROTTLE_CODES
+    return False
+
+def retry_after(error):
+    """Seconds the provider asked us to wait, from a Retry-After style header, if any."""
+    response = getattr(error, 'response', None)
+    headers = getattr(error, 'headers', None) or getattr(response, 'headers', None) or {}
+    try:
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms']) / 1000
+        if headers.get('retry-after'):
+            return float(headers['retry-after'])
+    except (TypeError, ValueError):
+        pass
+    return None
+
+def backoff(attempt):
+    # Exponential backoff with full jitter
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+async def call_with_retry(provider, request, retries = None, kind = 'respond', model = None):
+    """Await request() under the provider's limiter, backing off between failed attempts.
+
+    retries=None keeps trying until the call succeeds; otherwise the last
+    error is raised after that many retries. Every call is recorded in the
+    run's metrics sidecar, if one is active, with the latency of its last
+    attempt and the total time including queueing and backoff.
+    """
+    attempt = 0
+    errors = []
+    started, clock = time.time(), time.monotonic()
+    latency = 0.0
+
+    def record(ok, errors):
+        metrics.record_call(provider, kind, model, started, latency, time.monotonic() - clock, attempt + 1, errors, ok, usage)
+
+    with metrics.track() as usage:
+        try:
+            while True:
+                async with provider_slot(provider) as limiter:
+                    sent = time.monotonic()
+                    try:
+                        result = await request()
+                    except Exception as error:
+                        latency = time.monotonic() - sent
+                        failure = error
+                        errors.append(type(error).__name__)
+                        wait = retry_after(error)
+                        if is_throttle(error):
+                            limiter.on_throttle(wait, sent)
+                    else:
+                        latency = time.monotonic() - sent
+                        limiter.on_success()
+                        record(True, errors)
+                        return result
+                if retries is not None and attempt >= retries:
+                    record(False, errors)
+                    raise failure
+                print(f"{provider}: {failure} (retry {attempt + 1})")
+                await asyncio.sleep(wait or backoff(attempt))
+                attempt += 1
+        except asyncio.CancelledError:
+            # Outvoted judge calls are cancelled once the vote is decided
+            record(False, errors + ['CancelledError'])
+            raise
@@ -0,0 +1,190 @@
+import contextvars
+import json
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from contextlib import contextmanager
+
+# Token usage of respondent calls, in provider-neutral names. Totals cover the
+# whole run; track() additionally collects the usage of the calls made within
+# it, e.g. to store with the row a response belongs to.
+USAGE_FIELDS = ['input_tokens', 'output_tokens', 'cache_read_tokens', 'cache_write_tokens']
+totals = Counter()
+# Usage scopes opened by track(), innermost last
+current = contextvars.ContextVar('usage', default=())
+
+def usage_of(completion):
+    """Read token usage from an OpenAI, Anthropic or Cohere completion; empty if it has none."""
+    usage = getattr(completion, 'usage', None)
+    if usage is not None and hasattr(usage, 'prompt_tokens'):
+        details = getattr(usage, 'prompt_tokens_details', None)
+        return Counter({
+            'input_tokens': usage.prompt_tokens,
+            'output_tokens': usage.completion_tokens,
+            'cache_read_tokens': getattr(details, 'cached_tokens', None) or 0,
+            })
+    if usage is not None:
+        # Anthropic counts cached prompt tokens separately from input_tokens
+        read = getattr(usage, 'cache_read_input_tokens', None) or 0
+        written = getattr(usage, 'cache_creation_input_tokens', None) or 0
+        return Counter({
+            'input_tokens': (getattr(usage, 'input_tokens', None) or 0) + read + written,
+            'output_tokens': getattr(usage, 'output_tokens', None) or 0,
+            'cache_read_tokens': read,
+            'cache_write_tokens': written,
+            })
+    billed = getattr(getattr(completion, 'meta', None), 'billed_units', None)
+    if billed is not None:
+        return Counter({
+            'input_tokens': int(getattr(billed, 'input_tokens', None) or 0),
+            'output_tokens': int(getattr(billed, 'output_tokens', None) or 0),
+            })
+    return Counter()
+
+def record_usage(completion, propagate = True):
+    """Add a completion's usage to the run totals and every open scope.
+
+    With propagate=False (judge calls) it only reaches the innermost scope,
+    i.e. the call's own metrics record, so respondent totals stay separate.
+    """
+    usage = usage_of(completion)
+    scopes = current.get()
+    if not propagate:
+        scopes = scopes[-1:]
+    else:
+        totals.update(usage)
+    for scope in scopes:
+        scope.update(usage)
+
+@contextmanager
+def track():
+    """Collect the usage of the calls made inside the block, including tasks it starts."""
+    usage = Counter()
+    token = current.set(current.get() + (usage,))
+    try:
+        yield usage
+    finally:
+        current.reset(token)
+
+def usage_summary():
+    if not totals['input_tokens']:
+        return "No token usage reported"
+    share = totals['cache_read_tokens'] / totals['input_tokens']
+    return f"{totals['input_tokens']} input tokens ({totals['cache_read_tokens']}, {share:.1%}, read from the provider prompt cache; {totals['cache_write_tokens']} written to it), {totals['output_tokens']} output tokens"
+
+# Per-call records. Calls made while a run's sidecar is active (see sidecar())
+# are written to it as JSON lines, followed by rolling per-provider summaries.
+ROLLING_WINDOW = 60.0
+SUMMARY_INTERVAL = 30.0
+sink = contextvars.ContextVar('sink', default=None)
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q / 100 * len(values)))]
+
+def latency_stats(latencies):
+    return {f'p{q}': percentile(latencies, q) for q in (50, 95, 99)}
+
+class Sidecar:
+    """JSONL file of call and judge vote records for one run, with rolling summaries and stage totals."""
+    def __init__(self, path, append = False, summary_interval = SUMMARY_INTERVAL, window = ROLLING_WINDOW):
+        # A resumed run adds to its records; a fresh one replaces them, as the row writer does
+        self.file = open(path, 'a' if append else 'w')
+        self.lock = threading.Lock()
+        self.summary_interval = summary_interval
+        self.window = window
+        self.started = time.monotonic()
+        self.last_summary = self.started
+        # provider -> (finished, latency, attempts, failed attempts) of calls in the rolling window
+        self.recent = defaultdict(deque)
+        self.latencies = defaultdict(list)
+        self.counts = defaultdict(Counter)
+        self.stages = Counter()
+        self.votes = Counter()
+
+    def write(self, entry):
+        self.file.write(json.dumps(entry) + '\n')
+
+    def record(self, entry):
+        with self.lock:
+            self.write(entry)
+            if entry['type'] == 'call':
+                provider = entry['provider']
+                now = time.monotonic()
+                self.recent[provider].append((now, entry['latency'], entry['attempts'], len(entry['errors'])))
+                self.latencies[provider].append(entry['latency'])
+                self.counts[provider].update(calls=1, attempts=entry['attempts'], errors=len(entry['errors']), failed=not entry['ok'])
+            elif entry['type'] == 'judge_vote':
+                self.votes[entry['judgments']] += 1
+            if time.monotonic() - self.last_summary >= self.summary_interval:
+                self.write(self.summary())
+                self.last_summary = time.monotonic()
+            self.file.flush()
+
+    def add_stage(self, stage, seconds):
+        # Stage times are only totalled, in the final summary, to keep the file small
+        with self.lock:
+            self.stages[stage] += seconds
+
+    def summary(self, final = False):
+        now = time.monotonic()
+        providers = {}
+        for provider, recent in self.recent.items():
+            while recent and recent[0][0] < now - self.window:
+                recent.popleft()
+            span = min(self.window, now - self.started) or 1
+            attempts = sum(item[2] for item in recent)
+            if final:
+                calls, latencies = self.counts[provider]['calls'], self.latencies[provider]
+                attempts, errors, span = self.counts[provider]['attempts'], self.counts[provider]['errors'], now - self.started or 1
+            else:
+                calls, latencies, errors = len(recent), [item[1] for item in recent], sum(item[3] for item in recent)
+            providers[provider] = {
+                'calls': calls,
+                'throughput': calls / span,
+                'error_rate': errors / attempts if attempts else 0,
+                **latency_stats(latencies),
+                }
+        summary = {'type': 'final_summary' if final else 'summary', 'time': time.time(), 'elapsed': now - self.started, 'providers': providers}
+        if final:
+            summary['stages'] = dict(self.stages)
+            summary['judge_votes'] = {str(judgments): count for judgments, count in sorted(self.votes.items())}
+        return summary
+
+    def close(self):
+        with self.lock:
+            self.write(self.summary(final=True))
+            self.file.close()
+
+@contextmanager
+def sidecar(path, append = False):
+    """Send the records of everything run inside the block, including tasks it starts, to a sidecar file."""
+    run_sidecar = Sidecar(path, append)
+    token = sink.set(run_sidecar)
+    try:
+        yield run_sidecar
+    finally:
+        sink.reset(token)
+        run_sidecar.close()
+
+def record(entry):
+    run_sidecar = sink.get()
+    if run_sidecar is not None:
+        run_sidecar.record(entry)
+
+def record_call(provider, kind, model, started, latency, total, attempts, errors, ok, usage):
+    record({
+        'type': 'call', 'provider': provider, 'kind': kind, 'model': model, 'time': started,
+        'latency': latency, 'total': total, 'attempts': attempts, 'errors': errors, 'ok': ok, **usage,
+        })
+
+def record_judge_vote(judge_kind, judgments, verdict):
+    # judgments is 3 when the first round agreed and up to 7 with the tie-break round
+    record({'type': 'judge_vote', 'kind': judge_kind, 'judgments': judgments, 'verdict': verdict})
+
+def record_stage(stage, seconds):
+    run_sidecar = sink.get()
+    if run_sidecar is not None:
+        run_sidecar.add_stage(stage, seconds)
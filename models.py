@@ -1,37 +1,334 @@
-import numpy as np
-from openai import OpenAI
-from anthropic import AnthropicBedrock
-import cohere
-import boto3
-import botocore
-import os, sys, json
+import asyncio
+import time
+import json
 from collections import Counter
-
-
-
-client_openai = OpenAI()
-client_anthropic = AnthropicBedrock(
-    aws_access_key=os.environ['AWS_ACCESS_KEY'],
-    aws_secret_key=os.environ['AWS_SECRET_KEY'],
-    aws_region="us-east-1",
-)
-client_bedrock = boto3.client(
-    'bedrock-runtime',
-    aws_access_key_id=os.environ['AWS_ACCESS_KEY'],
-    aws_secret_access_key=os.environ['AWS_SECRET_KEY'],
-    region_name="us-east-1",
-    )
-client_cohere = cohere.Client(os.environ['COHERE_API_KEY'])
+from limits import call_with_retry
+from providers import get_client
+import metrics
+from metrics import record_usage
+import extract
+from cache import open_response_cache, open_judge_cache, model_response_cache
+
+
+
+JUDGE_SYSTEM = 'You are a response classifier. Output one letter option (like A, B, C, D, E, or None) and nothing else.'
+JUDGE_SYSTEM_ARGUMENT = 'You are a response classifier. Output one word option (like Conclusion, Conclusion_Opposite or None) and nothing else.'
+JUDGE_SEEDS = [1, 10, 100]
+JUDGE_ADDITIONAL_SEEDS = [1000, 1500, 2000, 2500]  # Arbitrary new seeds
+# Verdicts shared by every model; see set_judge_cache
+judge_cache = None
+# Judge requests per batched call; 1 sends every response on its own
+judge_batch_size = 1
+judge_batchers = {}
+
+
+
+def set_judge_cache(cache):
+    global judge_cache
+    judge_cache = cache
+
+def set_judge_batch_size(batch_size):
+    global judge_batch_size
+    judge_batch_size = batch_size
+    judge_batchers.clear()
+
+def add_model_arguments(parser):
+    parser.add_argument('--judge_batch_size', type=int, default=1, help='Number of responses classified per judge call')
+    parser.add_argument('--prompt_caching', action='store_true', help='Mark the fixed part of the prompts for provider prompt caching; PVQ prompts move the persona into a cacheable system prompt')
+    parser.add_argument('--stream_cutoff', action='store_true', help='Stream responses and stop reading once the answer is settled by the rule-based extractor')
+
+def configure_models(models, args):
+    """Apply the caching, streaming and judging options of the command line to the respondent models and the shared judge."""
+    response_cache = open_response_cache(args)
+    for model in models:
+        model.response_cache = model_response_cache(model, response_cache, args)
+        model.prompt_caching = args.prompt_caching
+        model.stream_cutoff = args.stream_cutoff
+    set_judge_cache(open_judge_cache(args))
+    extract.set_threshold(args.extract_threshold)
+    set_judge_batch_size(args.judge_batch_size)
+
+def judge_batcher(judge_model, kind):
+    """Return the shared batcher for this judge model and kind of question."""
+    if (judge_model, kind) not in judge_batchers:
+        judge_batchers[(judge_model, kind)] = JudgeBatcher(judge_model, kind, judge_batch_size)
+    return judge_batchers[(judge_model, kind)]
+
+def lookup_verdict(judge_model, kind, prompt, response):
+    """Return the memoized verdict and its key, or None for the verdict on a miss."""
+    if judge_cache is None:
+        return None, None
+    key = judge_cache.key(judge_model, kind, prompt, response)
+    return judge_cache.get(key), key
+
+def store_verdict(key, judge_model, verdict):
+    # 'NONE' is also what a vote without any successful judgment returns, so it is not memoized
+    if key is not None and verdict != 'NONE':
+        judge_cache.put(key, judge_model, verdict)
+
+def judge_messages(system_prompt, judge_prompt):
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": judge_prompt}
+    ]
+
+# Retries of a single judge call before its vote is dropped
+JUDGE_RETRIES = 2
+
+async def ajudge_once(judge_model, system_prompt, judge_prompt, label, seed):
+    try:
+        completion = await call_with_retry('openai', lambda: get_client('openai_async').chat.completions.create(
+            model=judge_model,
+            messages=judge_messages(system_prompt, judge_prompt),
+            timeout=15,
+            seed=seed,
+        ), retries=JUDGE_RETRIES, kind='judge', model=judge_model)
+        record_usage(completion, propagate=False)
+        response = completion.choices[0].message.content.strip().upper().replace('.', '')
+        return label(response)
+    except Exception as error:
+        print(error)
+
+async def ajudge_vote(judge_model, system_prompt, judge_prompt, label):
+    """Ask the judge with several seeds concurrently and return the majority label."""
+    votes = {}
+
+    async def ask(seed):
+        votes[seed] = await ajudge_once(judge_model, system_prompt, judge_prompt, label, seed)
+
+    async def ask_until(seeds, decided):
+        tasks = [asyncio.create_task(ask(seed)) for seed in seeds]
+        finished = 0
+        try:
+            for finished, next_vote in enumerate(asyncio.as_completed(tasks), 1):
+                await next_vote
+                if decided(len(seeds) - finished):
+                    break
+        finally:
+            for task in tasks:
+                task.cancel()
+        return finished
+
+    judgments = await ask_until(JUDGE_SEEDS, lambda remaining: has_majority(seed_ordered(votes)))
+    if not has_majority(seed_ordered(votes)):
+        print('No majority found. Requesting additional judgment.')
+        judgments += await ask_until(JUDGE_ADDITIONAL_SEEDS, lambda remaining: is_settled(seed_ordered(votes), remaining))
+    verdict = final_vote(seed_ordered(votes))
+    metrics.record_judge_vote('single', judgments, verdict)
+    return verdict
+
+def seed_ordered(votes):
+    # Labels in seed order rather than in the order the calls finished, so
+    # final_vote breaks a tie the same way on every run
+    return [votes[seed] for seed in JUDGE_SEEDS + JUDGE_ADDITIONAL_SEEDS if votes.get(seed) is not None]
+
+def has_majority(responses):
+    # A strict majority of the first round: two of the three seeds agree
+    counter = Counter(responses)
+    return bool(responses) and counter.most_common(1)[0][1] > len(JUDGE_SEEDS) // 2
+
+def is_settled(responses, remaining):
+    # The leading label wins even if every outstanding judgment goes to the runner-up
+    ranked = Counter(responses).most_common(2)
+    if not ranked:
+        return False
+    runner_up = ranked[1][1] if len(ranked) > 1 else 0
+    return ranked[0][1] - runner_up > remaining
+
+def final_vote(responses):
+    # Count the frequency of each response and find the most common one
+    try:
+        counter = Counter(responses)
+        most_common_final = counter.most_common(1)
+        return most_common_final[0][0]
+    except Exception as additional_error:
+        print('No majority found. Returning NONE.')
+        print(additional_error)
+        return 'NONE'
+
+
+JUDGE_BATCH_SYSTEM = {
+    'option': 'You are a response classifier. For every numbered item output one letter option (like A, B, C, D, E, F, or None). Reply with a JSON array of the labels in item order and nothing else.',
+    'argument': 'You are a response classifier. For every numbered item output one word option (like Conclusion, Conclusion_Opposite or None). Reply with a JSON array of the labels in item order and nothing else.',
+}
+JUDGE_BATCH_LABELS = {
+    'option': ['A', 'B', 'C', 'D', 'E', 'F', 'N'],
+    'argument': ['CONCLUSION', 'CONCLUSION_OPPOSITE', 'NONE'],
+}
+
+class JudgeBatcher:
+    """Collect judge requests from concurrent items and classify up to batch_size of them per call.
+
+    Each batch is voted on like a single response: all seeds of the first round
+    are sent at once, and only items without a majority go on to the tie-break
+    seeds. A reply that is not a JSON array of valid labels is retried as two
+    smaller batches until single items are reached.
+    """
+    def __init__(self, judge_model, kind, batch_size, max_wait = 0.05):
+        self.judge_model = judge_model
+        self.kind = kind
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.pending = []
+        self.timer = None
+        self.tasks = set()
+
+    async def classify(self, prompt, response, argument = None):
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append(((prompt, response, argument), future))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.max_wait, self.flush)
+        return await future
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending, []
+        if batch:
+            task = asyncio.create_task(self.vote(batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    def judge_prompt(self, items):
+        if self.kind == 'option':
+            header = "Your job is: for each numbered item, given a question with options, and response, determine to which option the response is potining to. That is, classify each response to discrete labels: A, B, C, D, E, F, or None."
+            blocks = [f"Item {number}:\nQuestion: '{prompt}'\nResponse: '{response}'" for number, (prompt, response, _) in enumerate(items, 1)]
+        else:
+            header = "Your job is: for each numbered item, given a question with options, and response, determine to which option the response is potining to. That is, classify each response to discrete labels: Conclusion, Conclusion_Opposite or None."
+            blocks = [
+                f"Item {number}:\nQuestion: '{prompt}'\nConclusion: '{argument['Conclusion']}'\nConclusion_Opposite: '{argument['Conclusion_Opposite']}'\nResponse: '{response}'"
+                for number, (prompt, response, argument) in enumerate(items, 1)
+                ]
+        return header + "\n\n" + "\n\n".join(blocks) + f"\n\nInterpretations (a JSON array of {len(items)} labels):"
+
+    def parse_labels(self, content, count):
+        """Return the validated labels of a batched reply, or None if it is malformed."""
+        content = content.strip().removeprefix('```json').removeprefix('```').removesuffix('```')
+        try:
+            labels = json.loads(content)
+        except ValueError:
+            return None
+        if not isinstance(labels, list) or len(labels) != count:
+            return None
+        labels = [str(label).strip().upper().replace('.', '') for label in labels]
+        if self.kind == 'option':
+            labels = [label[:1] for label in labels]
+        if any(label not in JUDGE_BATCH_LABELS[self.kind] for label in labels):
+            return None
+        return labels
+
+    async def ask(self, items, seed):
+        """Classify items with one seed, splitting the batch whenever the reply is malformed."""
+        try:
+            completion = await call_with_retry('openai', lambda: get_client('openai_async').chat.completions.create(
+                model=self.judge_model,
+                messages=judge_messages(JUDGE_BATCH_SYSTEM[self.kind], self.judge_prompt(items)),
+                timeout=15 + 5 * len(items),
+                seed=seed,
+            ), retries=JUDGE_RETRIES, kind='judge_batch', model=self.judge_model)
+            record_usage(completion, propagate=False)
+            labels = self.parse_labels(completion.choices[0].message.content, len(items))
+        except Exception as error:
+            print(error)
+            labels = None
+        if labels is not None:
+            return labels
+        if len(items) == 1:
+            return [None]
+        middle = len(items) // 2
+        first, second = await asyncio.gather(self.ask(items[:middle], seed), self.ask(items[middle:], seed))
+        return first + second
+
+    async def vote(self, batch):
+        items = [item for item, _ in batch]
+        # Per item, the label of every seed; see seed_ordered
+        votes = [{} for _ in items]
+
+        async def ask_seed(subset, seed):
+            return seed, await self.ask(subset, seed)
+
+        async def ask_until(indices, seeds, decided):
+            subset = [items[index] for index in indices]
+            tasks = [asyncio.create_task(ask_seed(subset, seed)) for seed in seeds]
+            try:
+                for finished, next_labels in enumerate(asyncio.as_completed(tasks), 1):
+                    seed, labels = await next_labels
+                    for index, label in zip(indices, labels):
+                        votes[index][seed] = label
+                    if all(decided(seed_ordered(votes[index]), len(seeds) - finished) for index in indices):
+                        break
+            finally:
+                for task in tasks:
+                    task.cancel()
+
+        try:
+            await ask_until(range(len(items)), JUDGE_SEEDS, lambda responses, remaining: has_majority(responses))
+            undecided = [index for index in range(len(items)) if not has_majority(seed_ordered(votes[index]))]
+            if undecided:
+                print(f'No majority found for {len(undecided)} of {len(items)} batched responses. Requesting additional judgment.')
+                await ask_until(undecided, JUDGE_ADDITIONAL_SEEDS, is_settled)
+            for (_, future), item_votes in zip(batch, votes):
+                responses = seed_ordered(item_votes)
+                if not future.done():
+                    future.set_result(final_vote(responses))
+                    # Judgments that counted towards this item's vote
+                    metrics.record_judge_vote('batch', len(responses), future.result())
+        except BaseException as error:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(error)
+            raise
+
+
+
+def read_stream(chunks, detect):
+    """Join streamed text chunks, stopping as soon as detect's answer is settled."""
+    detector = extract.StreamDetector(detect)
+    try:
+        for chunk in chunks:
+            if detector.feed(chunk):
+                extract.stats['stream_cutoff'] += 1
+                break
+    finally:
+        chunks.close()
+    return detector.text
+
+async def aread_stream(chunks, detect):
+    detector = extract.StreamDetector(detect)
+    try:
+        async for chunk in chunks:
+            if detector.feed(chunk):
+                extract.stats['stream_cutoff'] += 1
+                break
+    finally:
+        # Closing the generator closes the provider's stream and stops generation
+        await chunks.aclose()
+    return detector.text
 
 
 
 class BaseModel:
+    provider = None
+    # Generation parameters sent with every request; part of the cache key
+    generation = {}
+    response_cache = None
+    # Mark the system prompt for provider-side prompt caching where the SDK supports it
+    prompt_caching = False
+    # Stream responses and stop once the rules can settle the answer (models with stream/astream)
+    stream_cutoff = False
+    # Keep finished responses for the life of the model, so every prompt is asked once (set by sweep.py)
+    keep_responses = False
+
     def __init__(self):
         self.judge_model = "gpt-3.5-turbo-0125"
+        # In-flight arespond calls, so concurrent identical requests share one call; see keep_responses
+        self.pending = {}
 
-    def parse_response(self, prompt, response):
-        client = OpenAI()
-        judge_prompt = f"""
+    def judge_prompt(self, prompt, response):
+        return f"""
         Your job is: given a question with options, and response, determine to which option the response is potining to. That is, classify a given response to discrete labels: A, B, C, D, E, F, or None.
 
         Question: '{prompt}'
@@ -39,63 +336,87 @@ class BaseModel:
         Interpretation (only A, B, C, D, E, or None): 
         """
 
-        responses = []
-        seeds = [1, 10, 100]
-
-        for seed in seeds:
-            try:
-                completion = client.chat.completions.create(
-                    model=self.judge_model,
-                    messages=[
-                        {"role": "system", "content": 'You are a response classifier. Output one letter option (like A, B, C, D, E, or None) and nothing else.'},
-                        {"role": "user", "content": judge_prompt}
-                    ],
-                    timeout=15,
-                    seed=seed,
-                )
-                response = completion.choices[0].message.content.strip().upper().replace('.', '')
-                responses.append(response[0])
-            except KeyboardInterrupt:
-                sys.exit()
-            except Exception as error:
-                print(error)
-        # Count the frequency of each response and find the most common one
-        counter = Counter(responses)
-        most_common = counter.most_common(2)
-        # Check for majority
-        if most_common[0][1] > 1:
-            # Majority found
-            return most_common[0][0]
+    async def aparse_response(self, prompt, response):
+        verdict = extract.resolve_option(prompt, response)
+        if verdict is not None:
+            return verdict
+        verdict, key = lookup_verdict(self.judge_model, 'option', prompt, response)
+        if verdict is None:
+            if judge_batch_size > 1:
+                verdict = await judge_batcher(self.judge_model, 'option').classify(prompt, response)
+            else:
+                verdict = await ajudge_vote(self.judge_model, JUDGE_SYSTEM, self.judge_prompt(prompt, response), lambda r: r[0])
+            store_verdict(key, self.judge_model, verdict)
+        return verdict
+
+    def cache_key(self, user_prompt, system_prompt):
+        # A cut-off response is shorter than the full one, so they are cached apart
+        params = {**self.generation, 'stream_cutoff': True} if self.streams() else self.generation
+        return self.response_cache.key(self.model, system_prompt, user_prompt, params)
+
+    def streams(self):
+        return self.stream_cutoff and (hasattr(self, 'stream') or hasattr(self, 'astream'))
+
+    def detector(self, user_prompt, argument):
+        """The rule the streamed response is checked against, or None to read it in full."""
+        if not self.streams():
+            return None
+        if argument:
+            return lambda text: extract.extract_argument(user_prompt, argument, text)
+        return lambda text: extract.extract_option(user_prompt, text)
+
+    def cached(self, user_prompt, system_prompt):
+        if self.response_cache is None:
+            return None
+        return self.response_cache.get(self.cache_key(user_prompt, system_prompt))
+
+    def store(self, user_prompt, system_prompt, response):
+        if self.response_cache is not None:
+            self.response_cache.put(self.cache_key(user_prompt, system_prompt), self.model, response)
+
+    async def arespond(self, user_prompt, system_prompt = None, argument = None):
+        key = (system_prompt, user_prompt)
+        if key not in self.pending:
+            task = asyncio.ensure_future(self.arespond_once(user_prompt, system_prompt, argument))
+            task.add_done_callback(lambda task: self.settle(key, task))
+            self.pending[key] = task
+        # Shielded so that one cancelled caller does not cancel the call for the others
+        return await asyncio.shield(self.pending[key])
+
+    def settle(self, key, task):
+        # Finished calls are forgotten unless keep_responses is set; failed ones always are
+        if not self.keep_responses or task.cancelled() or task.exception() is not None:
+            self.pending.pop(key, None)
+
+    async def arespond_once(self, user_prompt, system_prompt = None, argument = None):
+        started = time.monotonic()
+        response = self.cached(user_prompt, system_prompt)
+        if response is None:
+            response = await self.arequest_with_retry(user_prompt, system_prompt, self.detector(user_prompt, argument))
+            self.store(user_prompt, system_prompt, response)
+        parsing = time.monotonic()
+        metrics.record_stage('respond', parsing - started)
+        if argument:
+            parsed_response = await self.aparse_response_argument(user_prompt, argument, response)
         else:
-            print('No majority found. Requesting additional judgment.')
-            # No majority, request an additional judgment
-            additional_seeds = [1000, 1500, 2000, 2500]  # An arbitrary new seed
-            for seed in additional_seeds:
-                try:
-                    completion = client.chat.completions.create(
-                        model=self.judge_model,
-                        messages=[
-                            {"role": "system", "content": 'You are a response classifier. Output one letter option (like A, B, C, D, E, or None) and nothing else.'},
-                            {"role": "user", "content": judge_prompt}
-                        ],
-                        timeout=15,
-                        seed=seed,
-                    )
-                    response = completion.choices[0].message.content.strip().upper().replace('.', '')
-                    responses.append(response[0])
-                except KeyboardInterrupt:
-                    sys.exit()
-                except Exception as error:
-                    print(error)
-            # Count the frequency of each response and find the most common one
-            try:
-                counter = Counter(responses)
-                most_common_final = counter.most_common(1)
-                return most_common_final[0][0]
-            except Exception as additional_error:
-                print('No majority found. Returning NONE.')
-                print(additional_error)
-                return 'NONE'
+            parsed_response = await self.aparse_response(user_prompt, response)
+        metrics.record_stage('parse', time.monotonic() - parsing)
+        return response, parsed_response
+
+    async def arequest_with_retry(self, user_prompt, system_prompt = None, detect = None):
+        # Retried with backoff until the provider returns text
+        async def request():
+            if detect is not None and hasattr(self, 'astream'):
+                response = await aread_stream(self.astream(user_prompt, system_prompt), detect)
+            elif detect is not None:
+                # Blocking SDK: read the stream in a worker thread
+                response = await asyncio.to_thread(read_stream, self.stream(user_prompt, system_prompt), detect)
+            else:
+                response = await self.arequest(user_prompt, system_prompt)
+            if response is None:
+                raise ValueError(f"{self.model} returned no text")
+            return response
+        return await call_with_retry(self.provider, request, model=self.model)
 
 
 
@@ -103,9 +424,8 @@ class BaseModel_Scenario:
     def __init__(self):
         self.judge_model = "gpt-3.5-turbo-0125"
 
-    def parse_response_argument(self, prompt, argument, response):
-        client = OpenAI()
-        judge_prompt = f"""
+    def judge_prompt_argument(self, prompt, argument, response):
+        return f"""
         Your job is: given a question with options, and response, determine to which option the response is potining to. That is, classify a given response to discrete labels: Conclusion, Conclusion_Opposite or None.
 
         Question: '{prompt}'
@@ -115,249 +435,211 @@ class BaseModel_Scenario:
         Interpretation (only Conclusion, Conclusion_Opposite or None): 
         """
 
-        responses = []
-        seeds = [1, 10, 100]
-
-        for seed in seeds:
-            try:
-                completion = client.chat.completions.create(
-                    model=self.judge_model,
-                    messages=[
-                        {"role": "system", "content": 'You are a response classifier. Output one word option (like Conclusion, Conclusion_Opposite or None) and nothing else.'},
-                        {"role": "user", "content": judge_prompt}
-                    ],
-                    timeout=15,
-                    seed=seed,
-                )
-                response = completion.choices[0].message.content.strip().upper().replace('.', '')
-                responses.append(response)
-            except KeyboardInterrupt:
-                sys.exit()
-            except Exception as error:
-                print(error)
-        # Count the frequency of each response and find the most common one
-        counter = Counter(responses)
-        most_common = counter.most_common(2)
-        # Check for majority
-        if most_common[0][1] > 1:
-            # Majority found
-            return most_common[0][0]
-        else:
-            print('No majority found. Requesting additional judgment.')
-            # No majority, request an additional judgment
-            additional_seeds = [1000, 1500, 2000, 2500]  # An arbitrary new seed
-            for seed in additional_seeds:
-                try:
-                    completion = client.chat.completions.create(
-                        model=self.judge_model,
-                        messages=[
-                            {"role": "system", "content": 'You are a response classifier. Output one word option (like Conclusion, Conclusion_Opposite or None) and nothing else.'},
-                            {"role": "user", "content": judge_prompt}
-                        ],
-                        timeout=15,
-                        seed=seed,
-                    )
-                    response = completion.choices[0].message.content.strip().upper().replace('.', '')
-                    responses.append(response)
-                except KeyboardInterrupt:
-                    sys.exit()
-                except Exception as error:
-                    print(error)
-            # Count the frequency of each response and find the most common one
-            try:
-                counter = Counter(responses)
-                most_common_final = counter.most_common(1)
-                return most_common_final[0][0]
-            except Exception as additional_error:
-                print('No majority found. Returning NONE.')
-                print(additional_error)
-                return 'NONE'
+    async def aparse_response_argument(self, prompt, argument, response):
+        verdict = extract.resolve_argument(prompt, argument, response)
+        if verdict is not None:
+            return verdict
+        verdict, key = lookup_verdict(self.judge_model, 'argument', prompt, response)
+        if verdict is None:
+            if judge_batch_size > 1:
+                verdict = await judge_batcher(self.judge_model, 'argument').classify(prompt, response, argument)
+            else:
+                verdict = await ajudge_vote(self.judge_model, JUDGE_SYSTEM_ARGUMENT, self.judge_prompt_argument(prompt, argument, response), lambda r: r)
+            store_verdict(key, self.judge_model, verdict)
+        return verdict
 
 
 
 class ChatGPT(BaseModel, BaseModel_Scenario):
+    provider = 'openai'
+    generation = {'seed': 1}
+
     def __init__(self):
         self.model = "gpt-3.5-turbo-0125"
         super().__init__()
 
-    def respond(self, user_prompt, system_prompt = None, argument = None):
-        response = None
-        while response is None:
-            try:
-                if argument:
-                    completion = client_openai.chat.completions.create(
-                        model=self.model,
-                        messages=[
-                            {"role": "system", "content": f"{system_prompt}"},
-                            {"role": "user", "content": f"{user_prompt}"}
-                        ],
-                        timeout=15,
-                        seed=1
-                    )
-                    response = completion.choices[0].message.content
-                    break
-                else:
-                    completion = client_openai.chat.completions.create(
-                        model=self.model,
-                        messages=[
-                            {"role": "user", "content": f"{user_prompt}"}
-                        ],
-                        timeout=15,
-                        seed=1
-                    )
-                    response = completion.choices[0].message.content
-                    break
-            except KeyboardInterrupt:
-                sys.exit()
-            except Exception as error:
-                print(error)
-        if argument:
-            parsed_response = self.parse_response_argument(user_prompt, argument, response)
-        else:
-            parsed_response = self.parse_response(user_prompt, response)
-        return response, parsed_response
+    def messages(self, user_prompt, system_prompt):
+        messages = [{"role": "user", "content": f"{user_prompt}"}]
+        if system_prompt:
+            messages.insert(0, {"role": "system", "content": f"{system_prompt}"})
+        return messages
+
+    async def arequest(self, user_prompt, system_prompt = None):
+        completion = await get_client('openai_async').chat.completions.create(
+            model=self.model,
+            messages=self.messages(user_prompt, system_prompt),
+            timeout=15,
+            **self.generation
+        )
+        record_usage(completion)
+        return completion.choices[0].message.content
+
+    async def astream(self, user_prompt, system_prompt = None):
+        stream = await get_client('openai_async').chat.completions.create(
+            model=self.model,
+            messages=self.messages(user_prompt, system_prompt),
+            timeout=15,
+            stream=True,
+            **self.generation
+        )
+        try:
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        finally:
+            await stream.close()
 
 
 
 class Claude3Sonnet(BaseModel, BaseModel_Scenario):
+    provider = 'anthropic'
+    generation = {'max_tokens': 1024}
+
     def __init__(self):
         self.model = "anthropic.claude-3-sonnet-20240229-v1:0"
         super().__init__()
 
-    def respond(self, user_prompt, system_prompt = None, argument = None):
-        response = None
-        while response is None:
-            try:
-                if argument:
-                    completion = client_anthropic.messages.create(
-                        model=self.model,
-                        system=system_prompt,
-                        messages=[
-                            {"role": "user", "content": f"{user_prompt}"}
-                        ],
-                        max_tokens=1024,
-                    )
-                    response = completion.content[0].text
-                    break
-                else:
-                    completion = client_anthropic.messages.create(
-                        model=self.model,
-                        messages=[
-                            {"role": "user", "content": f"{user_prompt}"}
-                        ],
-                        max_tokens=1024,
-                    )
-                    response = completion.content[0].text
-                    break
-            except KeyboardInterrupt:
-                sys.exit()
-            except Exception as error:
-                print(error)
-        if argument:
-            parsed_response = self.parse_response_argument(user_prompt, argument, response)
-        else:
-            parsed_response = self.parse_response(user_prompt, response)
-        return response, parsed_response
+    def params(self, user_prompt, system_prompt):
+        params = {
+            'model': self.model,
+            'messages': [{"role": "user", "content": f"{user_prompt}"}],
+            **self.generation,
+        }
+        if system_prompt and self.prompt_caching:
+            params['system'] = [{"type": "text", "text": system_prompt, "cache_control": {"type": "ephemeral"}}]
+        elif system_prompt:
+            params['system'] = system_prompt
+        return params
+
+    async def arequest(self, user_prompt, system_prompt = None):
+        completion = await get_client('anthropic_async').messages.create(**self.params(user_prompt, system_prompt))
+        record_usage(completion)
+        return completion.content[0].text
+
+    async def astream(self, user_prompt, system_prompt = None):
+        stream = await get_client('anthropic_async').messages.create(**self.params(user_prompt, system_prompt), stream=True)
+        try:
+            async for event in stream:
+                if event.type == 'content_block_delta' and getattr(event.delta, 'text', None):
+                    yield event.delta.text
+        finally:
+            await stream.close()
 
 
 
 class CommandRPlus(BaseModel, BaseModel_Scenario):
+    provider = 'cohere'
+    generation = {'seed': 1}
+
     def __init__(self):
         self.model = "command-r-plus"
         super().__init__()
 
-    def respond(self, user_prompt, system_prompt = None, argument = None):
-        response = None
-        while response is None:
-            try:
-                if argument:
-                    completion = client_cohere.chat(
-                        model=self.model,
-                        chat_history=[
-                            {"role": "SYSTEM", "text": f"{system_prompt}"},
-                        ],
-                        message=f"{user_prompt}",
-                        seed=1
-                    )
-                    response = completion.text
-                    break
-                else:
-                    completion = client_cohere.chat(
-                        model=self.model,
-                        message=f"{user_prompt}",
-                        seed=1
-                    )
-                    response = completion.text
-                    break
-            except KeyboardInterrupt:
-                sys.exit()
-            except Exception as error:
-                print(error)
-        if argument:
-            parsed_response = self.parse_response_argument(user_prompt, argument, response)
-        else:
-            parsed_response = self.parse_response(user_prompt, response)
-        return response, parsed_response
+    def params(self, user_prompt, system_prompt):
+        params = {
+            'model': self.model,
+            'message': f"{user_prompt}",
+            **self.generation,
+        }
+        if system_prompt:
+            params['chat_history'] = [{"role": "SYSTEM", "text": f"{system_prompt}"}]
+        return params
+
+    async def arequest(self, user_prompt, system_prompt = None):
+        completion = await get_client('cohere_async').chat(**self.params(user_prompt, system_prompt))
+        record_usage(completion)
+        return completion.text
+
+    async def astream(self, user_prompt, system_prompt = None):
+        async for event in get_client('cohere_async').chat_stream(**self.params(user_prompt, system_prompt)):
+            if event.event_type == 'text-generation':
+                yield event.text
+
+
+
+class BedrockModel(BaseModel, BaseModel_Scenario):
+    provider = 'bedrock'
+
+    def body(self, user_prompt, system_prompt = None):
+        raise NotImplementedError
 
+    def output(self, response_body):
+        raise NotImplementedError
 
+    def request(self, user_prompt, system_prompt = None):
+        results = get_client('bedrock').invoke_model(
+            modelId=self.model,
+            body=json.dumps(self.body(user_prompt, system_prompt))
+        )
+        response_body = json.loads(results["body"].read())
+        return self.output(response_body)
+
+    async def arequest(self, user_prompt, system_prompt = None):
+        # boto3 is blocking, so run it in a worker thread
+        return await asyncio.to_thread(self.request, user_prompt, system_prompt)
+
+    def stream(self, user_prompt, system_prompt = None):
+        results = get_client('bedrock').invoke_model_with_response_stream(
+            modelId=self.model,
+            body=json.dumps(self.body(user_prompt, system_prompt))
+        )
+        try:
+            # Streamed chunks have the same shape as a full response body
+            for event in results["body"]:
+                if 'chunk' in event:
+                    yield self.output(json.loads(event['chunk']['bytes']))
+        finally:
+            results["body"].close()
+
+
+
+class Mistral8x7BInst(BedrockModel):
+    generation = {"max_tokens": 1024, "temperature": 0}
 
-class Mistral8x7BInst(BaseModel):
     def __init__(self):
         self.model = "mistral.mixtral-8x7b-instruct-v0:1"
         super().__init__()
 
-    def respond(self, user_prompt):
-        body = {
+    def body(self, user_prompt, system_prompt = None):
+        # Mixtral has no system turn, so the system prompt leads the instruction
+        if system_prompt:
+            user_prompt = f"{system_prompt}\n\n{user_prompt}"
+        return {
                 "prompt": f"<s>[INST] {user_prompt} [/INST]",
-                "max_tokens": 1024,
-                "temperature": 0,
+                **self.generation,
             }
-        
-        response = None
-        while response is None:
-            try:
-                results = client_bedrock.invoke_model(
-                    modelId=self.model,
-                    body=json.dumps(body)
-                )
-                response_body = json.loads(results["body"].read())
-                outputs = response_body.get("outputs")
-                response = outputs[0]['text']
-                break
-            except KeyboardInterrupt:
-                sys.exit()
-            except Exception as error:
-                print(error)
-        parsed_response = self.parse_response(user_prompt, response)
-        return response, parsed_response
 
+    def output(self, response_body):
+        outputs = response_body.get("outputs")
+        return outputs[0]['text']
 
 
-class LLaMA2_70BChat(BaseModel):
+
+class LLaMA2_70BChat(BedrockModel):
+    generation = {"max_gen_len": 1024, "temperature": 0}
+
     def __init__(self):
         self.model = "meta.llama2-70b-chat-v1"
         super().__init__()
 
-    def respond(self, user_prompt):
-        body = {
+    def body(self, user_prompt, system_prompt = None):
+        if system_prompt:
+            user_prompt = f"<<SYS>>\n{system_prompt}\n<</SYS>>\n\n{user_prompt}"
+        return {
                 "prompt": f"<s>[INST] {user_prompt} [/INST]",
-                "max_gen_len": 1024,
-                "temperature": 0,
+                **self.generation,
             }
-        
-        response = None
-        while response is None:
-            try:
-                results = client_bedrock.invoke_model(
-                    modelId=self.model,
-                    body=json.dumps(body)
-                )
-                response_body = json.loads(results["body"].read())
-                response = response_body["generation"]
-                break
-            except KeyboardInterrupt:
-                sys.exit()
-            except Exception as error:
-                print(error)
-        parsed_response = self.parse_response(user_prompt, response)
-        return response, parsed_response
\ No newline at end of file
+
+    def output(self, response_body):
+        return response_body["generation"]
+
+
+
+# Command line names of the respondent models; a model is only instantiated once chosen
+MODELS = {
+    'Claude3Sonnet': Claude3Sonnet,
+    'ChatGPT': ChatGPT,
+    'Mistral8x7BInst': Mistral8x7BInst,
+    'LLaMA2-70BChat': LLaMA2_70BChat,
+    'CommandRPlus': CommandRPlus,
+}
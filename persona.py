@@ -1,135 +1,136 @@
+import os
 import random
 from datetime import datetime
 import numpy as np 
 
-def generate_persona_description(personas_per_question):    
-    # Define variable categories
-    sexes = ["Male", "Female"]#
-    age_brackets = range(20, 81)#
-    income_levels = range(1, 11)#
-    have_children_options = ["Yes", "No"]#
-    marriage_statuses = ["Married", "Living together as married", "Divorced", "Separated", "Widowed", "Single"]#
-    education_levels = ["Early childhood education", "Primary education", "Lower secondary education", 
-                        "Upper secondary education", "Post-secondary non-tertiary education", 
-                        "Short-cycle tertiary education", "Bachelor or equivalent", 
-                        "Master or equivalent", "Doctoral or equivalent"]#
-    employment_statuses = ["full-time", "part-time", "not"]#
-    occupation_groups = ["Professional and technical", "Higher administrative", "Clerical", "Sales", "Service", "Skilled worker", "Semi-skilled worker", "Unskilled worker", "Farm worker", "Farm proprietor, farm manager"]#
-    ethnic_groups = ["White", "Black", "South Asian", "East Asian",  "Arabic", "Central Asian"]#
-    religious_denominations = ["do not belong to a denomination", "Roman Catholic", "Protestant", "Orthodox", "Jew", "Muslim", "Hindu", "Buddhist"]#
-    country_code_dict = {
-        "8": "Albania",
-        "20": "Andorra",
-        "32": "Argentina",
-        "51": "Armenia",
-        "36": "Australia",
-        "40": "Austria",
-        "31": "Azerbaijan",
-        "50": "Bangladesh",
-        "112": "Belarus",
-        "68": "Bolivia",
-        "70": "Bosnia Herzegovina",
-        "76": "Brazil",
-        "100": "Bulgaria",
-        "124": "Canada",
-        "152": "Chile",
-        "156": "China",
-        "170": "Colombia",
-        "191": "Croatia",
-        "356": "India",
-        "196": "Cyprus",
-        "203": "Czechia",
-        "208": "Denmark",
-        "218": "Ecuador",
-        "818": "Egypt",
-        "233": "Estonia",
-        "231": "Ethiopia",
-        "246": "Finland",
-        "250": "France",
-        "268": "Georgia",
-        "276": "Germany",
-        "826": "Great Britain",
-        "300": "Greece",
-        "320": "Guatemala",
-        "344": "Hong Kong SAR",
-        "348": "Hungary",
-        "352": "Iceland",
-        "360": "Indonesia",
-        "364": "Iran",
-        "368": "Iraq",
-        "380": "Italy",
-        "392": "Japan",
-        "400": "Jordan",
-        "398": "Kazakhstan",
-        "404": "Kenya",
-        "417": "Kyrgyzstan",
-        "428": "Latvia",
-        "422": "Lebanon",
-        "434": "Libya",
-        "440": "Lithuania",
-        "446": "Macao SAR",
-        "458": "Malaysia",
-        "462": "Maldives",
-        "484": "Mexico",
-        "496": "Mongolia",
-        "499": "Montenegro",
-        "504": "Morocco",
-        "104": "Myanmar",
-        "528": "Netherlands",
-        "554": "New Zealand",
-        "558": "Nicaragua",
-        "566": "Nigeria",
-        "807": "North Macedonia",
-        "909": "Northern Ireland",
-        "578": "Norway",
-        "586": "Pakistan",
-        "604": "Peru",
-        "608": "Philippines",
-        "616": "Poland",
-        "620": "Portugal",
-        "630": "Puerto Rico",
-        "642": "Romania",
-        "643": "Russia",
-        "688": "Serbia",
-        "702": "Singapore",
-        "703": "Slovakia",
-        "705": "Slovenia",
-        "410": "South Korea",
-        "724": "Spain",
-        "752": "Sweden",
-        "756": "Switzerland",
-        "158": "Taiwan ROC",
-        "762": "Tajikistan",
-        "764": "Thailand",
-        "788": "Tunisia",
-        "792": "Turkey",
-        "804": "Ukraine",
-        "840": "United States",
-        "858": "Uruguay",
-        "862": "Venezuela",
-        "704": "Vietnam",
-        "716": "Zimbabwe"
-    }#
-    countries = list(country_code_dict.values())
+# Variable categories, shared by the samplers below
+SEXES = ["Male", "Female"]#
+AGE_BRACKETS = range(20, 81)#
+INCOME_LEVELS = range(1, 11)#
+HAVE_CHILDREN_OPTIONS = ["Yes", "No"]#
+MARRIAGE_STATUSES = ["Married", "Living together as married", "Divorced", "Separated", "Widowed", "Single"]#
+EDUCATION_LEVELS = ["Early childhood education", "Primary education", "Lower secondary education", 
+                    "Upper secondary education", "Post-secondary non-tertiary education", 
+                    "Short-cycle tertiary education", "Bachelor or equivalent", 
+                    "Master or equivalent", "Doctoral or equivalent"]#
+EMPLOYMENT_STATUSES = ["full-time", "part-time", "not"]#
+OCCUPATION_GROUPS = ["Professional and technical", "Higher administrative", "Clerical", "Sales", "Service", "Skilled worker", "Semi-skilled worker", "Unskilled worker", "Farm worker", "Farm proprietor, farm manager"]#
+ETHNIC_GROUPS = ["White", "Black", "South Asian", "East Asian",  "Arabic", "Central Asian"]#
+RELIGIOUS_DENOMINATIONS = ["do not belong to a denomination", "Roman Catholic", "Protestant", "Orthodox", "Jew", "Muslim", "Hindu", "Buddhist"]#
+COUNTRY_CODE_DICT = {
+    "8": "Albania",
+    "20": "Andorra",
+    "32": "Argentina",
+    "51": "Armenia",
+    "36": "Australia",
+    "40": "Austria",
+    "31": "Azerbaijan",
+    "50": "Bangladesh",
+    "112": "Belarus",
+    "68": "Bolivia",
+    "70": "Bosnia Herzegovina",
+    "76": "Brazil",
+    "100": "Bulgaria",
+    "124": "Canada",
+    "152": "Chile",
+    "156": "China",
+    "170": "Colombia",
+    "191": "Croatia",
+    "356": "India",
+    "196": "Cyprus",
+    "203": "Czechia",
+    "208": "Denmark",
+    "218": "Ecuador",
+    "818": "Egypt",
+    "233": "Estonia",
+    "231": "Ethiopia",
+    "246": "Finland",
+    "250": "France",
+    "268": "Georgia",
+    "276": "Germany",
+    "826": "Great Britain",
+    "300": "Greece",
+    "320": "Guatemala",
+    "344": "Hong Kong SAR",
+    "348": "Hungary",
+    "352": "Iceland",
+    "360": "Indonesia",
+    "364": "Iran",
+    "368": "Iraq",
+    "380": "Italy",
+    "392": "Japan",
+    "400": "Jordan",
+    "398": "Kazakhstan",
+    "404": "Kenya",
+    "417": "Kyrgyzstan",
+    "428": "Latvia",
+    "422": "Lebanon",
+    "434": "Libya",
+    "440": "Lithuania",
+    "446": "Macao SAR",
+    "458": "Malaysia",
+    "462": "Maldives",
+    "484": "Mexico",
+    "496": "Mongolia",
+    "499": "Montenegro",
+    "504": "Morocco",
+    "104": "Myanmar",
+    "528": "Netherlands",
+    "554": "New Zealand",
+    "558": "Nicaragua",
+    "566": "Nigeria",
+    "807": "North Macedonia",
+    "909": "Northern Ireland",
+    "578": "Norway",
+    "586": "Pakistan",
+    "604": "Peru",
+    "608": "Philippines",
+    "616": "Poland",
+    "620": "Portugal",
+    "630": "Puerto Rico",
+    "642": "Romania",
+    "643": "Russia",
+    "688": "Serbia",
+    "702": "Singapore",
+    "703": "Slovakia",
+    "705": "Slovenia",
+    "410": "South Korea",
+    "724": "Spain",
+    "752": "Sweden",
+    "756": "Switzerland",
+    "158": "Taiwan ROC",
+    "762": "Tajikistan",
+    "764": "Thailand",
+    "788": "Tunisia",
+    "792": "Turkey",
+    "804": "Ukraine",
+    "840": "United States",
+    "858": "Uruguay",
+    "862": "Venezuela",
+    "704": "Vietnam",
+    "716": "Zimbabwe"
+}#
+COUNTRIES = list(COUNTRY_CODE_DICT.values())
 
-    
+def generate_persona_description(personas_per_question):
+    """Draw personas one by one from the global random and np.random state, which ask.py seeds per run."""
     personas = []
+    current_year = datetime.now().year
     for _ in range(personas_per_question):
-        sex = random.choice(sexes)
-        age_bracket = random.choice(age_brackets)
-        current_year = current_year = datetime.now().year
+        sex = random.choice(SEXES)
+        age_bracket = random.choice(AGE_BRACKETS)
         birth_year = current_year - np.random.randint(age_bracket, age_bracket + 10)
         age = current_year - birth_year
-        income_level = random.choice(income_levels)
-        have_children = random.choice(have_children_options)
-        marriage_status = random.choice(marriage_statuses)
-        education_level = random.choice(education_levels)
-        employment_status = random.choice(employment_statuses)
-        occupation_group = random.choice(occupation_groups)
-        ethnic_group = random.choice(ethnic_groups)
-        religious_denomination = random.choice(religious_denominations)
-        country_of_residence = random.choice(countries)
-        country_of_origin = random.choice(countries)
+        income_level = random.choice(INCOME_LEVELS)
+        have_children = random.choice(HAVE_CHILDREN_OPTIONS)
+        marriage_status = random.choice(MARRIAGE_STATUSES)
+        education_level = random.choice(EDUCATION_LEVELS)
+        employment_status = random.choice(EMPLOYMENT_STATUSES)
+        occupation_group = random.choice(OCCUPATION_GROUPS)
+        ethnic_group = random.choice(ETHNIC_GROUPS)
+        religious_denomination = random.choice(RELIGIOUS_DENOMINATIONS)
+        country_of_residence = random.choice(COUNTRIES)
+        country_of_origin = random.choice(COUNTRIES)
         
         persona = f"You are a {sex} born in {birth_year}, which means that you are {age} years old. You were born in {country_of_origin} and you live in {country_of_residence}. Your income level is {income_level} out of 10. You are {'not married' if marriage_status == 'Single' else marriage_status.lower()}. You have {'no children' if have_children == 'No' else 'children'}. You have received {education_level.lower()} education. You are currently {employment_status} employed. {f'Your occupation group is {occupation_group}. ' if employment_status in ['full-time', 'part-time'] else ''}You are {ethnic_group}. You {'do not have a religion' if religious_denomination == 'do not belong to a denomination' else f'are {religious_denomination}'}."
         
@@ -149,4 +150,194 @@ def generate_persona_description(personas_per_question):
             'religious_denomination': religious_denomination,
         })
     
-    return personas
\ No newline at end of file
+    return personas
+
+# Vectorized sampler. Every attribute column is drawn at once from its own
+# child stream of the seed, so, as with the legacy sampler, the first n
+# personas of a seed are the same whatever the count. New columns must be
+# added at the end to keep the streams of the existing ones.
+CATEGORIES = {
+    'sex': SEXES,
+    'age_bracket': AGE_BRACKETS,
+    'age_offset': range(10),
+    'income_level': INCOME_LEVELS,
+    'have_children': HAVE_CHILDREN_OPTIONS,
+    'marrital_status': MARRIAGE_STATUSES,
+    'education_level': EDUCATION_LEVELS,
+    'employment_status': EMPLOYMENT_STATUSES,
+    'occupation_group': OCCUPATION_GROUPS,
+    'ethnic_group': ETHNIC_GROUPS,
+    'religious_denomination': RELIGIOUS_DENOMINATIONS,
+    'country_of_residence': COUNTRIES,
+    'coutry_of_origin': COUNTRIES,
+}
+# Description fragments per category, in the wording of generate_persona_description,
+# each with the fixed text that follows it so a description is a join of twelve pieces
+SEX_FRAGMENTS = [f'You are a {sex} born in ' for sex in SEXES]
+ORIGIN_FRAGMENTS = [f' years old. You were born in {country} and you live in ' for country in COUNTRIES]
+RESIDENCE_FRAGMENTS = [f'{country}. Your income level is ' for country in COUNTRIES]
+INCOME_FRAGMENTS = [f'{level} out of 10. You are ' for level in INCOME_LEVELS]
+MARRIAGE_FRAGMENTS = [f"{'not married' if status == 'Single' else status.lower()}. You have " for status in MARRIAGE_STATUSES]
+CHILDREN_FRAGMENTS = [f"{'no children' if option == 'No' else 'children'}. You have received " for option in HAVE_CHILDREN_OPTIONS]
+EDUCATION_FRAGMENTS = [f'{level.lower()} education. You are currently ' for level in EDUCATION_LEVELS]
+EMPLOYMENT_FRAGMENTS = [f'{status} employed. ' for status in EMPLOYMENT_STATUSES]
+OCCUPATION_FRAGMENTS = [f'Your occupation group is {group}. ' for group in OCCUPATION_GROUPS]
+ETHNIC_FRAGMENTS = [f'You are {group}. You ' for group in ETHNIC_GROUPS]
+RELIGION_FRAGMENTS = [f"{'do not have a religion' if religion == 'do not belong to a denomination' else f'are {religion}'}." for religion in RELIGIOUS_DENOMINATIONS]
+
+# Designs of the vectorized sampler. 'uniform' draws every attribute
+# independently. 'stratified' lays each attribute out as consecutive shuffled
+# blocks that hold every category once, so any prefix covers the categories
+# evenly (to within one) and the prefix property above still holds. 'lhs' is a
+# Latin hypercube for the given count: one point per 1/count stratum of every
+# attribute, paired at random across attributes; it is balanced as a whole
+# but a smaller count gives different personas.
+PERSONA_DESIGNS = ['uniform', 'stratified', 'lhs']
+
+def stratified_codes(rng, categories, count):
+    blocks = -(-count // categories)
+    return np.argsort(rng.random((blocks, categories)), axis=1).ravel()[:count]
+
+def latin_hypercube_codes(rng, categories, count):
+    return (rng.permutation(count) + rng.random(count)) * categories // count
+
+def sample_persona_columns(count, seed, design = 'uniform'):
+    """Draw the category index of every attribute of count personas."""
+    streams = np.random.SeedSequence(seed).spawn(len(CATEGORIES))
+    columns = {}
+    for (column, categories), stream in zip(CATEGORIES.items(), streams):
+        rng = np.random.default_rng(stream)
+        if design == 'stratified':
+            columns[column] = stratified_codes(rng, len(categories), count)
+        elif design == 'lhs':
+            columns[column] = latin_hypercube_codes(rng, len(categories), count).astype(np.int64)
+        else:
+            columns[column] = rng.integers(len(categories), size=count)
+    return columns
+
+def lookup(values, indices):
+    return np.asarray(values, dtype=object)[indices].tolist()
+
+def render_personas(columns, year):
+    """Turn the columns of a PersonaTable into persona dicts, rendering all descriptions at once."""
+    age = columns['age'].astype(np.int64)
+    employed = columns['employment_status'] < EMPLOYMENT_STATUSES.index('not')
+    occupation = np.where(employed, np.asarray(OCCUPATION_FRAGMENTS, dtype=object)[columns['occupation_group']], '')
+    pieces = [
+        lookup(SEX_FRAGMENTS, columns['sex']),
+        (year - age).astype(str).tolist(),
+        [', which means that you are '] * len(age),
+        age.astype(str).tolist(),
+        lookup(ORIGIN_FRAGMENTS, columns['coutry_of_origin']),
+        lookup(RESIDENCE_FRAGMENTS, columns['country_of_residence']),
+        lookup(INCOME_FRAGMENTS, columns['income_level']),
+        lookup(MARRIAGE_FRAGMENTS, columns['marrital_status']),
+        lookup(CHILDREN_FRAGMENTS, columns['have_children']),
+        lookup(EDUCATION_FRAGMENTS, columns['education_level']),
+        lookup(EMPLOYMENT_FRAGMENTS, columns['employment_status']),
+        occupation.tolist(),
+        lookup(ETHNIC_FRAGMENTS, columns['ethnic_group']),
+        lookup(RELIGION_FRAGMENTS, columns['religious_denomination']),
+        ]
+    fields = {
+        'description': list(map(''.join, zip(*pieces))),
+        'sex': lookup(SEXES, columns['sex']),
+        'age': age.tolist(),
+        }
+    for column in TABLE_COLUMNS[2:]:
+        fields[column] = lookup(CATEGORIES[column], columns[column])
+    keys = list(fields)
+    return [dict(zip(keys, values)) for values in zip(*fields.values())]
+
+# Columns of a PersonaTable: the age itself, and the code of every other
+# attribute in its vocabulary in CATEGORIES
+TABLE_COLUMNS = ['sex', 'age', 'coutry_of_origin', 'country_of_residence', 'income_level', 'marrital_status', 'have_children', 'education_level', 'employment_status', 'occupation_group', 'ethnic_group', 'religious_denomination']
+RENDER_CHUNK = 4096
+# Year the birth years of NumPy-sampled personas count from, fixed so that a
+# seed gives the same descriptions whenever it is run
+PERSONA_YEAR = 2024
+
+class PersonaTable:
+    """Personas as one small integer array per attribute, with descriptions rendered on demand.
+
+    A persona costs 12 bytes instead of a dict with its own description of
+    some 400 characters. The table is a sequence of persona dicts, like the
+    list generate_persona_description returns: indexing and iterating render
+    them, and slicing gives another table. It is saved to a .npz file, or to a
+    directory of .npy files that load() can memory-map.
+    """
+    def __init__(self, columns, year = PERSONA_YEAR):
+        self.columns = {column: np.asarray(columns[column], dtype=np.uint8) for column in TABLE_COLUMNS}
+        self.year = int(year)
+
+    @classmethod
+    def sample(cls, count, seed, year = PERSONA_YEAR, design = 'uniform'):
+        """Draw count personas with the vectorized sampler and one of PERSONA_DESIGNS."""
+        columns = sample_persona_columns(count, seed, design)
+        columns['age'] = np.asarray(AGE_BRACKETS)[columns.pop('age_bracket')] + columns.pop('age_offset')
+        return cls(columns, year)
+
+    @classmethod
+    def from_personas(cls, personas, year = PERSONA_YEAR):
+        """Encode persona dicts, e.g. from generate_persona_description, into a table."""
+        codes = {column: {value: code for code, value in enumerate(CATEGORIES[column])} for column in TABLE_COLUMNS if column != 'age'}
+        columns = {column: [persona[column] if column == 'age' else codes[column][persona[column]] for persona in personas] for column in TABLE_COLUMNS}
+        return cls(columns, year)
+
+    def __len__(self):
+        return len(self.columns['sex'])
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return PersonaTable({column: codes[index] for column, codes in self.columns.items()}, self.year)
+        return render_personas({column: codes[index:index + 1 or None] for column, codes in self.columns.items()}, self.year)[0]
+
+    def __iter__(self):
+        for start in range(0, len(self), RENDER_CHUNK):
+            yield from self[start:start + RENDER_CHUNK].personas()
+
+    def personas(self):
+        """Render the whole table as a list of persona dicts."""
+        return render_personas(self.columns, self.year)
+
+    def descriptions(self):
+        return [persona['description'] for persona in self]
+
+    def save(self, path):
+        if path.endswith('.npz'):
+            np.savez(path, year=self.year, **self.columns)
+            return
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, 'year.npy'), self.year)
+        for column, codes in self.columns.items():
+            np.save(os.path.join(path, f'{column}.npy'), codes)
+
+    @classmethod
+    def load(cls, path, mmap = False):
+        """Load a saved table; a directory of .npy files is memory-mapped with mmap=True."""
+        if path.endswith('.npz'):
+            with np.load(path) as data:
+                return cls({column: data[column] for column in TABLE_COLUMNS}, int(data['year']))
+        columns = {column: np.load(os.path.join(path, f'{column}.npy'), mmap_mode='r' if mmap else None) for column in TABLE_COLUMNS}
+        table = cls.__new__(cls)
+        # Kept as loaded, so memory-mapped columns are not copied
+        table.columns = columns
+        table.year = int(np.load(os.path.join(path, 'year.npy')))
+        return table
+
+def sample_personas(count, seed, year = PERSONA_YEAR):
+    """Vectorized counterpart of generate_persona_description, reproducible from the seed alone."""
+    return PersonaTable.sample(count, seed, year).personas()
+
+# 'vectorized' is the uniform design; 'stratified' and 'lhs' are the other designs
+PERSONA_SAMPLERS = ['legacy', 'vectorized', 'stratified', 'lhs']
+
+def add_persona_arguments(parser):
+    parser.add_argument('--persona_sampler', type=str, default='legacy', choices=PERSONA_SAMPLERS, help='Draw personas one by one as in the published runs, or all at once with a NumPy generator: uniformly (vectorized), in balanced blocks (stratified) or as a Latin hypercube (lhs)')
+    parser.add_argument('--persona_year', type=int, default=PERSONA_YEAR, help='Year the birth years of NumPy-sampled personas count from')
+
+def generate_personas(personas_per_question, seed, sampler = 'legacy', year = PERSONA_YEAR):
+    """Personas of a run; the legacy sampler relies on the global state that ask.set_experiment_parameters seeded, and dates them in the current year."""
+    if sampler == 'legacy':
+        return generate_persona_description(personas_per_question)
+    return PersonaTable.sample(personas_per_question, seed, year, design='uniform' if sampler == 'vectorized' else sampler)
@@ -0,0 +1,51 @@
+import os
+
+# Provider SDKs are imported and their clients built on first use, so a run
+# only pays for (and needs credentials of) the providers it actually calls.
+
+def build_openai_async():
+    from openai import AsyncOpenAI
+    return AsyncOpenAI()
+
+def build_anthropic_async():
+    from anthropic import AsyncAnthropicBedrock
+    return AsyncAnthropicBedrock(
+        aws_access_key=os.environ['AWS_ACCESS_KEY'],
+        aws_secret_key=os.environ['AWS_SECRET_KEY'],
+        aws_region="us-east-1",
+    )
+
+def build_bedrock():
+    import boto3
+    import botocore.config
+    # boto3 has no asyncio client; async calls run it in worker threads, so the
+    # connection pool has to be large enough for the configured concurrency
+    return boto3.client(
+        'bedrock-runtime',
+        aws_access_key_id=os.environ['AWS_ACCESS_KEY'],
+        aws_secret_access_key=os.environ['AWS_SECRET_KEY'],
+        region_name="us-east-1",
+        config=botocore.config.Config(max_pool_connections=64),
+        )
+
+def build_cohere_async():
+    import cohere
+    return cohere.AsyncClient(os.environ['COHERE_API_KEY'])
+
+client_factories = {
+    'openai_async': build_openai_async,
+    'anthropic_async': build_anthropic_async,
+    'bedrock': build_bedrock,
+    'cohere_async': build_cohere_async,
+}
+clients = {}
+
+def get_client(name):
+    """Return the named client, building it on first use."""
+    if name not in clients:
+        clients[name] = client_factories[name]()
+    return clients[name]
+
+def set_client(name, client):
+    """Install a client in place of the real one, e.g. a recording or replay backend."""
+    clients[name] = client
@@ -0,0 +1,130 @@
+import json
+import os
+import re
+from collections import Counter
+from engine import run_ordered
+from resume import load_completed, persona_question_key
+from runfile import RunWriter
+import extract
+import metrics
+
+# Questionnaire mode: each persona answers the whole PVQ in one call, as a JSON
+# object from statement number to letter option, instead of one call per
+# statement. Statements missing from the answer are asked again on their own.
+
+QUESTIONNAIRE_HEAD = "Let's role-play. I will ask you questions and you must give me answers. I want you to act as the person described below. Think from the person's perspective. \n\n"
+QUESTIONNAIRE_BODY = (
+    " \n\n"
+    "Use the given information to answer the questions below. For every statement, think about how much that person is or is not like you and choose one letter option.\n\n"
+    "OPTIONS:\n{options}\n\n"
+    "STATEMENTS:\n{statements}\n\n"
+    "Respond solely with a JSON object that maps every statement number to its letter option, like {example}."
+    )
+# Cache-friendly layout: the instructions and statements, which are the same
+# for every persona, form the system prompt and the persona is the user prompt
+QUESTIONNAIRE_SYSTEM = (
+    "Let's role-play. I will describe a person and ask you questions, and you must give me the answers of that person. Think from the person's perspective.\n\n"
+    "For every statement below, think about how much that person is or is not like you and choose one letter option.\n\n"
+    "OPTIONS:\n{options}\n\n"
+    "STATEMENTS:\n{statements}\n\n"
+    "Respond solely with a JSON object that maps every statement number to its letter option, like {example}."
+    )
+
+# Rounds of re-asking the statements a reply left out or answered invalidly
+MAX_ROUNDS = 3
+stats = Counter()
+
+def questionnaire_prompt(persona, questions, cache_layout = False):
+    """Return the user prompt and the system prompt (None unless cache_layout) asking the persona these questions."""
+    options = '\n'.join(f"{letter}. {option}" for letter, option in zip('ABCDEF', questions[0]['options']))
+    statements = '\n'.join(f"{question['question_number']}. {question['statement']}" for question in questions)
+    example = json.dumps({str(question['question_number']): letter for question, letter in zip(questions[:2], 'AF')})
+    if cache_layout:
+        return persona['description'], QUESTIONNAIRE_SYSTEM.format(options=options, statements=statements, example=example)
+    return QUESTIONNAIRE_HEAD + persona['description'] + QUESTIONNAIRE_BODY.format(options=options, statements=statements, example=example), None
+
+def parse_answers(response, questions):
+    """Return {question_number: (answer, letter)} for the statements the reply answered with a valid option."""
+    match = re.search(r'\{.*\}', response or '', re.S)
+    if not match:
+        return {}
+    try:
+        answers = json.loads(match.group(0))
+    except ValueError:
+        return {}
+    if not isinstance(answers, dict):
+        return {}
+    parsed = {}
+    for question in questions:
+        answer = str(answers.get(str(question['question_number']), '')).strip()
+        letter = extract.LEADING_LETTER.match(answer)
+        if letter:
+            parsed[question['question_number']] = (answer, letter.group(1))
+    return parsed
+
+async def ask_questionnaire(model, persona, questions, cache_layout = False):
+    """Ask one persona every question, re-asking the ones left unanswered, and return one row per question."""
+    answers = {}
+    missing = questions
+    for _ in range(MAX_ROUNDS):
+        prompt, system_prompt = questionnaire_prompt(persona, missing, cache_layout)
+        response = model.cached(prompt, system_prompt)
+        if response is None:
+            response = await model.arequest_with_retry(prompt, system_prompt)
+            model.store(prompt, system_prompt, response)
+        stats['calls'] += 1
+        answers.update(parse_answers(response, missing))
+        missing = [question for question in missing if question['question_number'] not in answers]
+        if not missing:
+            break
+    stats['personas'] += 1
+    stats['missing'] += len(missing)
+    rows = []
+    for question in questions:
+        response, parsed = answers.get(question['question_number'], ('', 'NONE'))
+        rows.append({
+            'prompt': f"{question['question_number']}. {question['statement']}",
+            'question_number': question['question_number'],
+            'persona': persona,
+            'response': response,
+            'response_parsed': parsed,
+            'mode': 'questionnaire',
+        })
+    return rows
+
+async def collect_questionnaires(
+    model, prompts_response_jsonl_path, console, log, progress, personas, questions, concurrency = 8, resume = False, cache_layout = False, output = None
+    ):
+    """Questionnaire counterpart of ask.collect_responses: one call per persona, rows written per question."""
+    completed = load_completed(prompts_response_jsonl_path, persona_question_key) if resume else Counter()
+
+    def remaining(persona):
+        # On resume, a persona is asked only the questions it has no row for yet
+        return [
+            question for question in questions
+            if not completed[persona_question_key({'question_number': question['question_number'], 'persona': persona})]
+            ]
+
+    work = ((persona, remaining(persona)) for persona in personas)
+
+    async def process(item):
+        persona, pending = item
+        return await ask_questionnaire(model, persona, pending, cache_layout) if pending else []
+
+    sidecar_path = os.path.join(os.path.dirname(prompts_response_jsonl_path), 'metrics.jsonl')
+    with RunWriter(prompts_response_jsonl_path, append=resume, **(output or {})) as outfile, metrics.sidecar(sidecar_path, append=resume):
+        task = progress.add_task(f"Retrieving Questionnaires from {model.model} ...", total=len(personas))
+
+        def save(rows):
+            for row in rows:
+                outfile.write(row)
+            if rows:
+                console.print(f"\nSaved Questionnaire of {len(rows)} Questions for Persona {rows[0]['persona']}")
+            progress.advance(task)
+            log.tick()
+
+        await run_ordered(work, process, save, concurrency)
+    log.close()
+
+def summary():
+    return f"{stats['personas']} questionnaires in {stats['calls']} calls, {stats['missing']} answers still missing"
@@ -0,0 +1,93 @@
+import json
+import os
+import argparse
+import asyncio
+from rich.console import Console
+from rich.markdown import Markdown
+from rich.progress import Progress
+from api_keys import set_api_keys
+set_api_keys()
+from models import BaseModel, BaseModel_Scenario, set_judge_cache, set_judge_batch_size
+from cache import add_judge_cache_arguments, open_judge_cache
+from engine import run_ordered
+from limits import set_concurrency
+import extract
+import metrics
+from replay import add_backend_arguments, install_backend
+from runfile import read_rows
+
+METHODS = ["A/B", "Repeat", "Compare"]
+
+class Judge(BaseModel, BaseModel_Scenario):
+    """Judge-only model used to re-parse responses that are already on disk."""
+
+def load_entries(file_path):
+    """Load the entries of a prompts-response.jsonl file, or of a run written in the compact format."""
+    return list(read_rows(file_path))
+
+def parsed_labels(entry):
+    if 'prompt' in entry:
+        return [entry.get('response_parsed')]
+    return [entry.get(f'{method} Response Parsed') for method in METHODS]
+
+async def rejudge_entry(judge, entry):
+    """Re-parse the responses of one persona question or one argument entry."""
+    if 'prompt' in entry:
+        entry['response_parsed'] = await judge.aparse_response(entry['prompt'], entry['response'])
+    else:
+        parsed = await asyncio.gather(*[
+            judge.aparse_response_argument(entry[f'{method} Prompt'], entry, entry[f'{method} Response']) for method in METHODS
+            ])
+        for method, label in zip(METHODS, parsed):
+            entry[f'{method} Response Parsed'] = label
+    return entry
+
+def parse_arguments():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description="Re-run the response judge over an existing run.")
+    parser.add_argument("input", type=str, help="Path to a prompts-response.jsonl file under runs/")
+    parser.add_argument("-o", "--output", type=str, default=None, help="Where to write the re-judged entries (defaults to prompts-response-rejudged.jsonl next to the input)")
+    parser.add_argument('-c', '--concurrency', type=int, default=8, help='Maximum judge requests in flight')
+    parser.add_argument('--judge_batch_size', type=int, default=1, help='Number of responses classified per judge call')
+    add_judge_cache_arguments(parser)
+    extract.add_extract_arguments(parser)
+    add_backend_arguments(parser)
+    return parser.parse_args()
+
+def main():
+    console = Console(record=True)
+    args = parse_arguments()
+    install_backend(args)
+    output_file = args.output or os.path.join(os.path.dirname(args.input), 'prompts-response-rejudged.jsonl')
+    set_judge_cache(open_judge_cache(args))
+    extract.set_threshold(args.extract_threshold)
+    set_judge_batch_size(args.judge_batch_size)
+    set_concurrency(args.concurrency)
+    judge = Judge()
+
+    console.print(
+        Markdown(f"""# REJUDGE \n 1. *Input*: {args.input} \n2. *Response Parsing Model*: {judge.judge_model} \n3. *Output*: {output_file}""")
+        )
+    entries = load_entries(args.input)
+    # Entries come back in input order, so compare against the old labels in the same order
+    previous = iter([parsed_labels(entry) for entry in entries])
+    changed = 0
+
+    sidecar_path = os.path.join(os.path.dirname(output_file), 'metrics-rejudge.jsonl')
+    with open(output_file, 'w') as outfile, metrics.sidecar(sidecar_path), Progress(console=console, transient=True) as progress:
+        task = progress.add_task("Re-judging Responses ...", total=len(entries))
+
+        def save(entry):
+            nonlocal changed
+            changed += parsed_labels(entry) != next(previous)
+            json.dump(entry, outfile)
+            outfile.write('\n')
+            progress.advance(task)
+
+        asyncio.run(run_ordered(entries, lambda entry: rejudge_entry(judge, entry), save, args.concurrency))
+
+    console.print(extract.summary())
+    console.log(f"{changed} of {len(entries)} entries changed. Results saved in {output_file}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,329 @@
+import asyncio
+import hashlib
+import io
+import json
+import os
+import random
+import re
+import threading
+import time
+from types import SimpleNamespace
+import extract
+import providers
+from runfile import find_runs, read_rows
+
+# Record/replay backends for the provider clients in providers.py. Recording
+# wraps the real clients and appends every request and its output to a JSONL
+# file; replay answers from recordings, falls back to responses found in past
+# runs, and adds configurable latency and errors so throughput changes can be
+# measured without live endpoints.
+
+JUDGE_RESPONSE = re.compile(r"Response: '(.*?)' ?\n\s*(?:Interpretation|$)", re.S)
+JUDGE_QUESTION = re.compile(r"Question: '(.*?)'\n\s*(?:Response|Conclusion):", re.S)
+JUDGE_CONCLUSIONS = re.compile(r"Conclusion: '(.*?)'\n\s*Conclusion_Opposite: '(.*?)'\n", re.S)
+
+def request_method(name, client):
+    """The single request method of a provider client that models.py calls."""
+    if name.startswith('openai'):
+        return client.chat.completions.create
+    if name.startswith('anthropic'):
+        return client.messages.create
+    if name.startswith('cohere'):
+        return client.chat
+    return client.invoke_model
+
+def stream_method(name, client):
+    """The streaming method of a provider client; OpenAI and Anthropic stream through create(stream=True)."""
+    if name.startswith('cohere'):
+        return client.chat_stream
+    if name.startswith('bedrock'):
+        return client.invoke_model_with_response_stream
+    return None
+
+def client_shape(name, call, stream = None):
+    """Build an object that exposes call() and stream() where the real client's request methods would be."""
+    if name.startswith('openai'):
+        return SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=call)))
+    if name.startswith('anthropic'):
+        return SimpleNamespace(messages=SimpleNamespace(create=call))
+    if name.startswith('cohere'):
+        return SimpleNamespace(chat=call, chat_stream=stream)
+    return SimpleNamespace(invoke_model=call, invoke_model_with_response_stream=stream)
+
+def output_of(name, result):
+    """The part of a provider result that models.py reads."""
+    if name.startswith('openai'):
+        return result.choices[0].message.content
+    if name.startswith('anthropic'):
+        return result.content[0].text
+    if name.startswith('cohere'):
+        return result.text
+    return json.loads(result['body'].read())
+
+def result_of(name, output):
+    """Wrap an output in the shape of the provider's result object."""
+    if name.startswith('openai'):
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=output))], usage=None)
+    if name.startswith('anthropic'):
+        return SimpleNamespace(content=[SimpleNamespace(text=output)], usage=None)
+    if name.startswith('cohere'):
+        return SimpleNamespace(text=output, meta=None)
+    return {'body': io.BytesIO(json.dumps(output).encode('utf-8'))}
+
+def request_key(name, request):
+    """Hash a request independently of sync/async client and timeout."""
+    request = {key: value for key, value in request.items() if key != 'timeout'}
+    if 'body' in request:
+        request['body'] = json.loads(request['body'])
+    payload = json.dumps([name.removesuffix('_async'), request], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+class Recorder:
+    """Append provider requests and outputs to a JSONL file."""
+    def __init__(self, path):
+        self.file = open(path, 'a')
+        self.lock = threading.Lock()
+
+    def write(self, name, request, output):
+        entry = {'client': name, 'key': request_key(name, request), 'request': request, 'output': output}
+        with self.lock:
+            self.file.write(json.dumps(entry, default=str) + '\n')
+            self.file.flush()
+
+def recording_client(name, client, recorder):
+    # Streamed requests go to the provider unrecorded, as they may be cut off early
+    method = request_method(name, client)
+    if name.endswith('_async'):
+        async def call(**request):
+            if request.get('stream'):
+                return await method(**request)
+            output = output_of(name, await method(**request))
+            recorder.write(name, request, output)
+            return result_of(name, output)
+    else:
+        def call(**request):
+            if request.get('stream'):
+                return method(**request)
+            output = output_of(name, method(**request))
+            recorder.write(name, request, output)
+            return result_of(name, output)
+    return client_shape(name, call, stream_method(name, client))
+
+def stream_events(name, output):
+    """Split an output into the word-sized stream events the provider would send."""
+    if name.startswith('bedrock'):
+        key = 'outputs' if 'outputs' in output else 'generation'
+        text = output['outputs'][0]['text'] if key == 'outputs' else output['generation']
+    else:
+        text = output
+    pieces = re.findall(r'\S+\s*|\s+', text) or ['']
+    if name.startswith('openai'):
+        return [SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=piece))]) for piece in pieces]
+    if name.startswith('anthropic'):
+        return [SimpleNamespace(type='content_block_delta', delta=SimpleNamespace(text=piece)) for piece in pieces]
+    if name.startswith('cohere'):
+        return [SimpleNamespace(event_type='text-generation', text=piece) for piece in pieces]
+    return [
+        {'chunk': {'bytes': json.dumps({'outputs': [{'text': piece}]} if key == 'outputs' else {'generation': piece}).encode('utf-8')}}
+        for piece in pieces
+        ]
+
+class ReplayStream:
+    """A fake provider stream: the first event arrives after a fifth of the latency, the rest spread over the remainder."""
+    def __init__(self, events, latency):
+        self.events = events
+        self.delays = [latency * 0.2] + [latency * 0.8 / len(events)] * (len(events) - 1)
+        self.closed = False
+
+    def __iter__(self):
+        for event, delay in zip(self.events, self.delays):
+            if self.closed:
+                return
+            time.sleep(delay)
+            yield event
+
+    def close(self):
+        self.closed = True
+
+class AsyncReplayStream(ReplayStream):
+    async def __aiter__(self):
+        for event, delay in zip(self.events, self.delays):
+            if self.closed:
+                return
+            await asyncio.sleep(delay)
+            yield event
+
+    async def close(self):
+        self.closed = True
+
+class ReplayError(Exception):
+    """A synthetic provider failure; 429s carry a Retry-After header like the real SDK errors."""
+    def __init__(self, status_code, retry_after = None):
+        super().__init__(f"replay: synthetic error {status_code}")
+        self.status_code = status_code
+        self.response = SimpleNamespace(headers={'retry-after': str(retry_after)} if retry_after else {})
+
+class ReplayBackend:
+    """Answer provider requests from recordings, then from past runs, then synthetically."""
+    def __init__(self, recordings = (), runs = 'runs/*/prompts-response.jsonl', latency = 0.0, latency_sigma = 0.5, error_rate = 0.0, throttle_share = 0.5, seed = 0):
+        self.latency = latency
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.throttle_share = throttle_share
+        self.random = random.Random(seed)
+        self.recorded = {}
+        for path in recordings:
+            with open(path) as file:
+                for line in file:
+                    entry = json.loads(line)
+                    self.recorded[entry['key']] = entry['output']
+        self.runs = runs
+        self.responses = None
+        self.labels = None
+
+    def load_runs(self):
+        # Index past runs lazily: prompt -> response, and normalized response -> parsed label
+        self.responses, self.labels = {}, {}
+        for path in find_runs(self.runs):
+            for entry in read_rows(path):
+                if 'prompt' in entry:
+                    self.responses[entry['prompt']] = entry['response']
+                    self.labels[extract.simplify(entry['response'])] = entry['response_parsed']
+                else:
+                    for method in ['A/B', 'Repeat', 'Compare']:
+                        if f'{method} Response' in entry:
+                            self.responses[entry[f'{method} Prompt']] = entry[f'{method} Response']
+                            self.labels[extract.simplify(entry[f'{method} Response'])] = entry[f'{method} Response Parsed']
+
+    def delay(self):
+        # Log-normal latency with the configured mean
+        if self.latency <= 0:
+            return 0
+        return self.latency * self.random.lognormvariate(-self.latency_sigma ** 2 / 2, self.latency_sigma)
+
+    def maybe_fail(self):
+        if self.random.random() < self.error_rate:
+            if self.random.random() < self.throttle_share:
+                raise ReplayError(429, retry_after=1)
+            raise ReplayError(500)
+
+    def answer(self, name, request):
+        self.maybe_fail()
+        key = request_key(name, request)
+        if key in self.recorded:
+            return self.recorded[key]
+        if self.responses is None:
+            self.load_runs()
+        system, prompt = self.split_request(name, request)
+        if system and 'response classifier' in system:
+            text = self.judge(system, prompt)
+        else:
+            text = self.respond(prompt, system)
+        if name.startswith('bedrock'):
+            return {'outputs': [{'text': text}]} if 'mistral' in request['modelId'] else {'generation': text}
+        return text
+
+    def split_request(self, name, request):
+        """Return the system prompt and user prompt of a request."""
+        if name.startswith('openai'):
+            messages = request['messages']
+            system = next((message['content'] for message in messages if message['role'] == 'system'), None)
+            return system, messages[-1]['content']
+        if name.startswith('anthropic'):
+            content = request['messages'][-1]['content']
+            if isinstance(content, list):
+                content = ''.join(block['text'] for block in content)
+            system = request.get('system')
+            if isinstance(system, list):
+                system = ''.join(block['text'] for block in system)
+            return system, content
+        if name.startswith('cohere'):
+            history = request.get('chat_history') or [{}]
+            return history[0].get('text'), request['message']
+        prompt = json.loads(request['body'])['prompt']
+        return None, prompt.removeprefix('<s>[INST] ').removesuffix(' [/INST]')
+
+    def respond(self, prompt, system = None):
+        if prompt in self.responses:
+            return self.responses[prompt]
+        questionnaire = prompt if 'STATEMENTS:' in prompt else system or ''
+        if 'STATEMENTS:' in questionnaire:
+            # Questionnaire: a letter for every statement, occasionally leaving one out
+            numbers = re.findall(r'^(\d+)\. ', questionnaire.split('STATEMENTS:')[1].split('\n\n')[0], re.M)
+            return json.dumps({number: self.random.choice('ABCDEF') for number in numbers if self.random.random() > 0.05})
+        if 'Respond solely with A or B.' in prompt:
+            return self.random.choice(['A', 'B'])
+        if 'Respond solely by repeating' in prompt:
+            return self.random.choice(re.findall(r'^- (.*)$', prompt, re.M) or ['None'])
+        if 'Respond solely with yes or no.' in prompt:
+            return self.random.choice(['Yes', 'No'])
+        if self.responses:
+            return self.random.choice(list(self.responses.values()))
+        return self.random.choice(['A', 'B', 'C', 'D', 'E', 'F'])
+
+    def judge(self, system, prompt):
+        if 'JSON array' in system:
+            items = re.split(r'^Item \d+:\n', prompt, flags=re.M)[1:]
+            return json.dumps([self.judge_item(item, system) for item in items])
+        return self.judge_item(prompt, system)
+
+    def judge_item(self, block, system):
+        response = JUDGE_RESPONSE.search(block + '\n')
+        response = response.group(1) if response else ''
+        question = JUDGE_QUESTION.search(block)
+        question = question.group(1) if question else ''
+        if 'Conclusion' in system:
+            conclusions = JUDGE_CONCLUSIONS.search(block)
+            if conclusions:
+                argument = {'Conclusion': conclusions.group(1), 'Conclusion_Opposite': conclusions.group(2)}
+                label, _ = extract.extract_argument(question, argument, response)
+                if label:
+                    return {'CONCLUSION': 'Conclusion', 'CONCLUSION_OPPOSITE': 'Conclusion_Opposite'}[label]
+            return self.random.choice(['Conclusion', 'Conclusion_Opposite'])
+        label = self.labels.get(extract.simplify(response)) or extract.extract_option(question, response)[0]
+        return label or self.random.choice(['A', 'B', 'C', 'D', 'E', 'F'])
+
+def replay_client(name, backend):
+    def stream(**request):
+        output = backend.answer(name, request)
+        if name.endswith('_async'):
+            return AsyncReplayStream(stream_events(name, output), backend.delay())
+        return {'body': ReplayStream(stream_events(name, output), backend.delay())}
+
+    if name.endswith('_async'):
+        async def call(**request):
+            if request.pop('stream', False):
+                return stream(**request)
+            await asyncio.sleep(backend.delay())
+            return result_of(name, backend.answer(name, request))
+    else:
+        def call(**request):
+            if request.pop('stream', False):
+                return stream(**request)
+            time.sleep(backend.delay())
+            return result_of(name, backend.answer(name, request))
+    return client_shape(name, call, stream)
+
+def add_backend_arguments(parser):
+    parser.add_argument('--backend', type=str, default='live', choices=['live', 'record', 'replay'], help='Call the providers, record their traffic, or replay it offline')
+    parser.add_argument('--recording', type=str, nargs='*', default=['recordings/provider-traffic.jsonl'], help='Recording file(s) to write (record) or read (replay)')
+    parser.add_argument('--replay_runs', type=str, default='runs/*/prompts-response.jsonl', help='Past runs used to synthesize replies missing from the recordings')
+    parser.add_argument('--replay_latency', type=float, default=0.0, help='Mean synthetic latency per replayed call, in seconds')
+    parser.add_argument('--replay_latency_sigma', type=float, default=0.5, help='Spread of the log-normal replay latency')
+    parser.add_argument('--replay_error_rate', type=float, default=0.0, help='Share of replayed calls that fail (half of them as 429 throttling)')
+
+def install_backend(args):
+    """Swap the provider client factories for recording or replay ones, keeping them lazy."""
+    if args.backend == 'record':
+        path = args.recording[0]
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        recorder = Recorder(path)
+        for name, build in list(providers.client_factories.items()):
+            providers.client_factories[name] = lambda name=name, build=build: recording_client(name, build(), recorder)
+    elif args.backend == 'replay':
+        backend = ReplayBackend(
+            [path for path in args.recording if os.path.exists(path)], args.replay_runs,
+            args.replay_latency, args.replay_latency_sigma, args.replay_error_rate
+            )
+        for name in providers.client_factories:
+            providers.client_factories[name] = lambda name=name: replay_client(name, backend)
@@ -0,0 +1,72 @@
+import json
+import os
+from collections import Counter
+from runfile import read_rows
+
+def persona_question_key(entry):
+    """Fingerprint of a PVQ entry: the question number and the full persona."""
+    return json.dumps([int(entry['question_number']), entry['persona']], sort_keys=True)
+
+def argument_key(entry):
+    """Fingerprint of an argument entry: its premise and both conclusions."""
+    return json.dumps([entry['Premise'], entry['Conclusion'], entry['Conclusion_Opposite']])
+
+def load_completed(file_path, key):
+    """Count the fingerprints of entries already written to a JSONL output file.
+
+    A torn last line, left behind by a crash in the middle of a write, is
+    truncated so that appending continues on a clean line boundary.
+    """
+    completed = Counter()
+    if not os.path.exists(file_path):
+        # Compact runs are repaired by runfile.RunWriter when reopened
+        for entry in read_rows(file_path):
+            completed[key(entry)] += 1
+        return completed
+    valid_until = 0
+    with open(file_path, 'rb') as file:
+        lines = file.readlines()
+    for number, line in enumerate(lines, 1):
+        try:
+            if not line.endswith(b'\n'):
+                raise ValueError('line is not terminated')
+            entry = json.loads(line)
+        except ValueError:
+            if number < len(lines):
+                raise ValueError(f"{file_path} line {number} is corrupt; refusing to resume over it")
+            print(f"Truncating torn last line of {file_path}")
+            with open(file_path, 'r+b') as file:
+                file.truncate(valid_until)
+            break
+        completed[key(entry)] += 1
+        valid_until += len(line)
+    return completed
+
+def remaining_entries(entries, completed, key):
+    """Lazily drop the entries whose fingerprints were already completed, once per completed copy."""
+    completed = completed.copy()
+    for entry in entries:
+        fingerprint = key(entry)
+        if completed[fingerprint] > 0:
+            completed[fingerprint] -= 1
+        else:
+            yield entry
+
+def load_reusable(file_paths, key, stream_cutoff = False):
+    """Map fingerprints to finished entries of other runs and the run directory that first produced each.
+
+    Runs may be in either output format. Unreadable lines are skipped, since a donor run may itself have been
+    interrupted in the middle of a write. Responses cut off by --stream_cutoff are only reused by runs that
+    cut off their own.
+    """
+    reusable = {}
+    for file_path in file_paths:
+        for entry in read_rows(file_path):
+            if entry.get('stream_cutoff') and not stream_cutoff:
+                continue
+            origin = entry.get('reused_from', os.path.dirname(file_path))
+            reusable.setdefault(key(entry), (entry, origin))
+    return reusable
+
+def add_reuse_arguments(parser):
+    parser.add_argument('--no_reuse', action='store_true', help='Do not reuse responses from earlier runs with the same seed and model but another persona count')
@@ -0,0 +1,252 @@
+import glob
+import gzip
+import json
+import os
+import time
+import zlib
+
+# Run output. The default format is the original prompts-response.jsonl, one
+# self-contained row per question-persona pair. The compact format stores
+# each row as a template id, question number and persona id next to the
+# response, with the personas and the prompt templates (the prompt with the
+# persona description cut out) written once each to side tables:
+#
+#   responses.jsonl[.gz|.zst]  {"template": 3, "question_number": 1, "persona": 0, "response": ..., ...}
+#   personas.jsonl             {"id": 0, "description": ..., "sex": ..., ...}
+#   templates.jsonl            {"id": 3, "prompt": "... {persona} ...", "system_prompt": ...}
+#
+# Rows are written in group commits: buffered, then written together with
+# the side table entries they refer to. Compressed rows are written as one
+# gzip member or zstd frame per commit, so a crash can only tear the last one.
+# read_rows() gives back rows in the original shape for either format.
+
+RESPONSES = {'none': 'responses.jsonl', 'gzip': 'responses.jsonl.gz', 'zstd': 'responses.jsonl.zst'}
+PERSONAS = 'personas.jsonl'
+TEMPLATES = 'templates.jsonl'
+PERSONA_MARK = '{persona}'
+
+def zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise SystemExit("zstd compression needs the zstandard package (pip install zstandard)")
+    return zstandard
+
+def compress(data, compression):
+    if compression == 'gzip':
+        return gzip.compress(data)
+    if compression == 'zstd':
+        return zstandard().ZstdCompressor().compress(data)
+    return data
+
+def members(data, compression):
+    """Split a responses file into its complete commits: (decompressed bytes, end offset) pairs."""
+    offset = 0
+    while offset < len(data):
+        if compression == 'none':
+            end = data.rfind(b'\n', offset) + 1
+            if end:
+                yield data[offset:end], end
+            return
+        if compression == 'gzip':
+            decompressor = zlib.decompressobj(wbits=31)
+        else:
+            decompressor = zstandard().ZstdDecompressor().decompressobj()
+        try:
+            chunk = decompressor.decompress(data[offset:])
+        except Exception:
+            return
+        if not decompressor.eof:
+            return
+        offset = len(data) - len(decompressor.unused_data)
+        yield chunk, offset
+
+def compact_responses(jsonl_path):
+    """The compact responses file of the run a prompts-response.jsonl path belongs to, and its compression."""
+    directory = os.path.dirname(jsonl_path)
+    for compression, name in RESPONSES.items():
+        if os.path.exists(os.path.join(directory, name)):
+            return os.path.join(directory, name), compression
+    return None, None
+
+def exists(jsonl_path):
+    return os.path.exists(jsonl_path) or compact_responses(jsonl_path)[0] is not None
+
+def find_runs(pattern):
+    """Glob for prompts-response.jsonl paths, including those of runs written in the compact format."""
+    paths = set(glob.glob(pattern))
+    for name in RESPONSES.values():
+        for path in glob.glob(os.path.join(os.path.dirname(pattern), name)):
+            paths.add(os.path.join(os.path.dirname(path), os.path.basename(pattern)))
+    return sorted(paths)
+
+def read_table(path):
+    table = {}
+    if os.path.exists(path):
+        with open(path, 'r') as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                table[entry.pop('id')] = entry
+    return table
+
+def expand(row, personas, templates):
+    """Rebuild a row in the prompts-response.jsonl shape from a compact one."""
+    persona = personas[row['persona']]
+    template = templates[row['template']]
+    expanded = {'prompt': template['prompt'].replace(PERSONA_MARK, persona.get('description', ''))}
+    if 'system_prompt' in template:
+        expanded['system_prompt'] = template['system_prompt'].replace(PERSONA_MARK, persona.get('description', ''))
+    expanded['question_number'] = row['question_number']
+    expanded['persona'] = persona
+    expanded.update((key, value) for key, value in row.items() if key not in ('template', 'question_number', 'persona'))
+    return expanded
+
+def read_rows(jsonl_path):
+    """Yield the rows of a run in the prompts-response.jsonl shape, whichever format it was written in.
+
+    Unreadable lines and a torn last commit are skipped.
+    """
+    if os.path.exists(jsonl_path):
+        with open(jsonl_path, 'r') as file:
+            for line in file:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+        return
+    path, compression = compact_responses(jsonl_path)
+    if path is None:
+        return
+    directory = os.path.dirname(path)
+    personas = read_table(os.path.join(directory, PERSONAS))
+    templates = read_table(os.path.join(directory, TEMPLATES))
+    with open(path, 'rb') as file:
+        data = file.read()
+    for chunk, _ in members(data, compression):
+        for line in chunk.splitlines():
+            try:
+                row = json.loads(line)
+            except ValueError:
+                continue
+            yield expand(row, personas, templates)
+
+class RunWriter:
+    """Write the rows of a run, either as prompts-response.jsonl or in the compact format.
+
+    Rows are committed in groups of commit_every, or once commit_interval
+    seconds have passed since the oldest buffered row; close() commits the rest.
+    """
+    def __init__(self, jsonl_path, output_format = 'jsonl', compression = 'none', append = False, commit_every = 1, commit_interval = 1.0):
+        if append and exists(jsonl_path):
+            # A resumed run keeps the format it was started in
+            compression = compact_responses(jsonl_path)[1] or compression
+            output_format = 'jsonl' if os.path.exists(jsonl_path) else 'compact'
+        self.compact = output_format == 'compact'
+        self.compression = compression if self.compact else 'none'
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        self.buffer = []
+        self.first_buffered = None
+        self.personas = {}
+        self.templates = {}
+        self.new_personas = []
+        self.new_templates = []
+        directory = os.path.dirname(jsonl_path)
+        if not append:
+            # A fresh run replaces the previous one, whatever format that was written in
+            for path in [jsonl_path, os.path.join(directory, PERSONAS), os.path.join(directory, TEMPLATES)] + [os.path.join(directory, name) for name in RESPONSES.values()]:
+                if os.path.exists(path):
+                    os.remove(path)
+        if not self.compact:
+            self.file = open(jsonl_path, 'ab')
+            return
+        self.path = os.path.join(directory, RESPONSES[self.compression])
+        self.personas_path = os.path.join(directory, PERSONAS)
+        self.templates_path = os.path.join(directory, TEMPLATES)
+        if append:
+            self.load()
+        self.file = open(self.path, 'ab')
+
+    def load(self):
+        # Continue the ids of the side tables and cut a commit torn by a crash
+        for persona_id, persona in read_table(self.personas_path).items():
+            self.personas[json.dumps(persona, sort_keys=True)] = persona_id
+        for template_id, template in read_table(self.templates_path).items():
+            self.templates[json.dumps(template, sort_keys=True)] = template_id
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as file:
+                data = file.read()
+            end = 0
+            for _, end in members(data, self.compression):
+                pass
+            if end < len(data):
+                print(f"Truncating torn last commit of {self.path}")
+                with open(self.path, 'r+b') as file:
+                    file.truncate(end)
+
+    def intern(self, table, new, value):
+        key = json.dumps(value, sort_keys=True)
+        if key not in table:
+            table[key] = len(table)
+            new.append({'id': table[key], **value})
+        return table[key]
+
+    def compact_row(self, row):
+        description = row['persona'].get('description')
+        template = {'prompt': row['prompt'].replace(description, PERSONA_MARK) if description else row['prompt']}
+        if 'system_prompt' in row:
+            template['system_prompt'] = row['system_prompt'].replace(description, PERSONA_MARK) if description else row['system_prompt']
+        compact = {
+            'template': self.intern(self.templates, self.new_templates, template),
+            'question_number': row['question_number'],
+            'persona': self.intern(self.personas, self.new_personas, row['persona']),
+            }
+        compact.update((key, value) for key, value in row.items() if key not in ('prompt', 'system_prompt', 'question_number', 'persona'))
+        return compact
+
+    def write(self, row):
+        self.buffer.append(self.compact_row(row) if self.compact else row)
+        if self.first_buffered is None:
+            self.first_buffered = time.monotonic()
+        if len(self.buffer) >= self.commit_every or time.monotonic() - self.first_buffered >= self.commit_interval:
+            self.commit()
+
+    def commit(self):
+        if not self.buffer:
+            return
+        # Side table entries go first, so every committed row can be expanded
+        for path, new in [(self.personas_path, self.new_personas), (self.templates_path, self.new_templates)] if self.compact else []:
+            if new:
+                with open(path, 'a') as file:
+                    file.writelines(json.dumps(entry) + '\n' for entry in new)
+                new.clear()
+        data = ''.join(json.dumps(row) + '\n' for row in self.buffer).encode('utf-8')
+        self.file.write(compress(data, self.compression))
+        self.file.flush()
+        if self.compact:
+            # Only compact commits are synced to disk; jsonl rows are flushed, as they always were
+            os.fsync(self.file.fileno())
+        self.buffer = []
+        self.first_buffered = None
+
+    def close(self):
+        self.commit()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def add_output_arguments(parser):
+    parser.add_argument('--output_format', type=str, default='jsonl', choices=['jsonl', 'compact'], help='Write prompts-response.jsonl, or compact rows with personas and prompt templates in side tables')
+    parser.add_argument('--compression', type=str, default='none', choices=['none', 'gzip', 'zstd'], help='Compress the rows of the compact format (zstd needs the zstandard package)')
+    parser.add_argument('--commit_every', type=int, default=1, help='Write rows in groups of this many')
+    parser.add_argument('--commit_interval', type=float, default=1.0, help='Write buffered rows at least this often, in seconds')
+
+def output_options(args):
+    return {'output_format': args.output_format, 'compression': args.compression, 'commit_every': args.commit_every, 'commit_interval': args.commit_interval}
@@ -0,0 +1,157 @@
+import argparse
+import json
+import numpy as np
+from rich.console import Console
+from rich.markdown import Markdown
+from rich.table import Table
+from persona import PersonaTable, CATEGORIES, TABLE_COLUMNS, PERSONA_DESIGNS
+from runfile import find_runs, read_rows
+from score import compute_scores
+
+# Compares persona sampling designs by the spread of the value scores they
+# give for a number of personas, offline. Respondents are simulated with an
+# additive model, per question, of how each persona attribute moves the
+# answer, fitted to the responses of past runs (or drawn at random when there
+# are none), plus noise with the residual spread. Each design and persona
+# count is sampled with many seeds; the noise is shared across designs, so
+# only the choice of personas differs.
+
+LETTERS = 'ABCDEF'
+AGE_BINS = 7
+
+def attribute_codes(table):
+    """Per attribute codes of a PersonaTable, with ages in decade bins."""
+    codes = {column: table.columns[column].astype(np.int64) for column in TABLE_COLUMNS if column != 'age'}
+    codes['age'] = np.minimum((table.columns['age'].astype(np.int64) - 20) // 10, AGE_BINS - 1)
+    return codes
+
+def category_counts():
+    return {column: AGE_BINS if column == 'age' else len(CATEGORIES[column]) for column in TABLE_COLUMNS}
+
+class Respondent:
+    """Additive answer model: a mean per question, plus one shift per attribute category, plus noise."""
+    def __init__(self, questions, means, effects, noise):
+        self.questions = questions
+        self.means = means
+        self.effects = effects
+        self.noise = noise
+
+    @classmethod
+    def fit(cls, questions, rows, shrinkage):
+        """Fit the model to past responses, shrinking the shift of rarely seen categories towards zero."""
+        numbers = {number: index for index, number in enumerate(questions)}
+        rows = [row for row in rows if row.get('response_parsed') in LETTERS and row.get('question_number') in numbers and 'persona' in row]
+        table = PersonaTable.from_personas([row['persona'] for row in rows])
+        codes = attribute_codes(table)
+        question = np.array([numbers[row['question_number']] for row in rows])
+        answer = np.array([LETTERS.index(row['response_parsed']) + 1 for row in rows], dtype=float)
+        means = np.bincount(question, answer, len(questions)) / np.maximum(np.bincount(question, minlength=len(questions)), 1)
+        residual = answer - means[question]
+        effects = {}
+        for column, categories in category_counts().items():
+            cell = question * categories + codes[column]
+            size = len(questions) * categories
+            totals = np.bincount(cell, residual, size)
+            counts = np.bincount(cell, minlength=size)
+            effects[column] = (totals / (counts + shrinkage)).reshape(len(questions), categories)
+        prediction = means[question] + sum(effects[column][question, codes[column]] for column in effects)
+        return cls(questions, means, effects, float(np.std(answer - prediction)))
+
+    @classmethod
+    def synthetic(cls, questions, seed = 0, effect_scale = 0.3, noise = 1.0):
+        rng = np.random.default_rng(seed)
+        effects = {column: rng.normal(0, effect_scale, (len(questions), categories)) for column, categories in category_counts().items()}
+        return cls(questions, rng.uniform(2, 5, len(questions)), effects, noise)
+
+    def answer(self, table, noise):
+        """Answers (1 to 6) of every persona of the table to every question, given standard normal noise."""
+        codes = attribute_codes(table)
+        latent = self.means[None, :] + self.noise * noise
+        for column, effect in self.effects.items():
+            latent += effect[:, codes[column]].T
+        return np.clip(np.rint(latent), 1, 6).astype(int)
+
+def value_scores(questions, answers):
+    """The ten value scores of score.compute_scores for a matrix of answers."""
+    responses = [
+        {'question_number': number, 'response_parsed': int(answer)}
+        for persona_answers in answers for number, answer in zip(questions, persona_answers)
+        ]
+    scores_10, _ = compute_scores(responses, float(answers.mean()))
+    return scores_10
+
+def score_variance(respondent, design, count, repeats):
+    """Mean variance, over the ten values, of the scores of repeated runs with count personas."""
+    scores = []
+    for repeat in range(repeats):
+        table = PersonaTable.sample(count, repeat, year=2024, design=design)
+        # The same noise for every design, so only the personas differ
+        noise = np.random.default_rng([repeat, count]).standard_normal((count, len(respondent.questions)))
+        scores.append(value_scores(respondent.questions, respondent.answer(table, noise)))
+    return float(np.mean([np.var([score[value] for score in scores]) for value in scores[0]]))
+
+def calls_to_match(variances, counts, target):
+    """Smallest persona count whose variance is at most target, interpolating between measured counts."""
+    previous = None
+    for count in counts:
+        if variances[count] <= target:
+            if previous is None or variances[previous] == variances[count]:
+                return count
+            share = (variances[previous] - target) / (variances[previous] - variances[count])
+            return previous + share * (count - previous)
+        previous = count
+    return None
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Compare persona sampling designs by the score variance they reach per API call.')
+    parser.add_argument('-n', '--counts', type=int, nargs='+', default=[5, 10, 15, 20, 25, 35, 50], help='Persona counts to measure')
+    parser.add_argument('--repeats', type=int, default=200, help='Simulated runs per design and persona count')
+    parser.add_argument('--designs', type=str, nargs='+', default=PERSONA_DESIGNS, choices=PERSONA_DESIGNS, help='Sampling designs to compare with uniform')
+    parser.add_argument('--runs', type=str, default='runs/*/prompts-response.jsonl', help='Past runs to fit the simulated respondent to')
+    parser.add_argument('--shrinkage', type=float, default=5.0, help='Pseudo-count shrinking the fitted attribute effects towards zero')
+    parser.add_argument('--synthetic', action='store_true', help='Use random attribute effects instead of fitting them to past runs')
+    return parser.parse_args()
+
+def main():
+    console = Console(record=True)
+    args = parse_arguments()
+    with open('benchmark/questions.jsonl') as file:
+        questions = [json.loads(line)['question_number'] for line in file]
+    rows = [] if args.synthetic else [row for path in find_runs(args.runs) for row in read_rows(path)]
+    respondent = Respondent.fit(questions, rows, args.shrinkage) if rows else Respondent.synthetic(questions)
+    designs = ['uniform'] + [design for design in args.designs if design != 'uniform']
+    counts = sorted(set(args.counts))
+    console.print(
+        Markdown(f"""# SAMPLING BENCHMARK \n 1. *RESPONDENT*: {'fitted to ' + str(len(rows)) + ' responses' if rows else 'synthetic'}, residual spread {respondent.noise:.2f} \n 2. *REPEATS*: {args.repeats} per design and persona count""")
+        )
+
+    variances = {design: {count: score_variance(respondent, design, count, args.repeats) for count in counts} for design in designs}
+
+    table = Table(title="Mean variance of the value scores")
+    table.add_column("Personas")
+    table.add_column("API calls")
+    for design in designs:
+        table.add_column(design)
+    for count in counts:
+        table.add_row(str(count), str(count * len(questions)), *[f"{variances[design][count]:.5f}" for design in designs])
+    console.print(table)
+
+    savings = Table(title="API calls to reach the variance of uniform sampling")
+    savings.add_column("Uniform personas")
+    for design in designs[1:]:
+        savings.add_column(design)
+    for count in counts:
+        cells = []
+        for design in designs[1:]:
+            matched = calls_to_match(variances[design], counts, variances['uniform'][count])
+            if matched is None:
+                cells.append('-')
+            else:
+                # At the smallest measured count only a bound is known
+                bound = '≤' if matched == counts[0] else ''
+                cells.append(f"{bound}{matched * len(questions):.0f} ({bound and '≥'}{1 - matched / count:.0%} saved)")
+        savings.add_row(f"{count} ({count * len(questions)} calls)", *cells)
+    console.print(savings)
+
+if __name__ == "__main__":
+    main()
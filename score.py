@@ -5,9 +5,9 @@ from rich.markdown import Markdown
 import plotly.graph_objects as go
 
 # Continue to import your other necessary modules
-import json
 from collections import defaultdict
 import numpy as np
+from runfile import read_rows
 
 def normalize_values(values):
     min_val = min(values)
@@ -18,60 +18,78 @@ def parse_responses(file_path):
     responses = []
     sum_all = 0
     n_res = 0
-    with open(file_path, 'r') as file:
-        for line in file:
-            data = json.loads(line)
-            mapping = {
-                'A': 1,
-                'B': 2,
-                'C': 3,
-                'D': 4,
-                'E': 5,
-                'F': 6
-            }
-            if data['response_parsed'] in ['A', 'B', 'C', 'D', 'E', 'F']:
-                sum_all += mapping[data['response_parsed']]
-                n_res += 1
-                responses.append(
-                    {
-                        'question_number': data['question_number'],
-                        'response_parsed': mapping[data['response_parsed']]
-                    })
+    adaptive = False
+    # Either output format; compact runs are expanded back to full rows
+    for data in read_rows(file_path):
+        mapping = {
+            'A': 1,
+            'B': 2,
+            'C': 3,
+            'D': 4,
+            'E': 5,
+            'F': 6
+        }
+        adaptive = adaptive or data.get('mode') == 'adaptive'
+        if data['response_parsed'] in ['A', 'B', 'C', 'D', 'E', 'F']:
+            sum_all += mapping[data['response_parsed']]
+            n_res += 1
+            responses.append(
+                {
+                    'question_number': data['question_number'],
+                    'response_parsed': mapping[data['response_parsed']]
+                })
     mrat = sum_all / n_res
+    if adaptive:
+        responses = question_means(responses)
+        mrat = np.mean([response['response_parsed'] for response in responses])
     return responses, mrat
 
+def question_means(responses):
+    """One response per question, rating the question with its mean.
+
+    Adaptive runs ask the questions of converged values of fewer personas, so
+    both score levels and the mean rating are taken over question means, which
+    weighs each question equally; with every question asked equally often the
+    scores are the usual ones.
+    """
+    answers = defaultdict(list)
+    for response in responses:
+        answers[response['question_number']].append(response['response_parsed'])
+    return [{'question_number': number, 'response_parsed': np.mean(question_answers)} for number, question_answers in answers.items()]
+
+# PVQ question numbers of each of the ten values and the four higher-order values
+VALUES_MAPPING_10 = {
+    "Self-Direction": [1,23,39,16,30,56],
+    "Tradition": [18,33,40,7,38,54],
+    "Conformity": [15,31,42,4,22,51],
+    "Stimulation": [10,28,43],
+    "Hedonism": [3,36,46],
+
+    "Achievement": [17,32,48],
+    "Universalism": [8,21,45,5,37,52,14,34,57],
+    "Power": [6,29,41,12,20,44 ],
+    "Benevolence": [11,25,47,19,27,55],
+    "Security": [13,26,53,2,35,50],
+}
+
+VALUES_MAPPING_HIGHER_ORDER = {
+    "Self-Transcendence": [8,21,45, 5,37,52, 14,34,57, 11,25,47, 19,27,55], 
+    "Self-Enhancement": [17,32,48, 6,29,41, 12,20,44], 
+    "Openness to change": [1,23,39, 16,30,56, 10,28,43, 3,36,46], 
+    "Conservation": [13,26,53, 2,35,50, 18,33,40, 15,31,42, 4,22,51], 
+}
+
 def compute_scores(responses, mrat):
     scores_10 = defaultdict(list)
     higher_order = defaultdict(list)
 
-    values_mapping_10 = {
-        "Self-Direction": [1,23,39,16,30,56],
-        "Tradition": [18,33,40,7,38,54],
-        "Conformity": [15,31,42,4,22,51],
-        "Stimulation": [10,28,43],
-        "Hedonism": [3,36,46],
-
-        "Achievement": [17,32,48],
-        "Universalism": [8,21,45,5,37,52,14,34,57],
-        "Power": [6,29,41,12,20,44 ],
-        "Benevolence": [11,25,47,19,27,55],
-        "Security": [13,26,53,2,35,50],
-    }
-
-    values_mapping_higher_order = {
-        "Self-Transcendence": [8,21,45, 5,37,52, 14,34,57, 11,25,47, 19,27,55], 
-        "Self-Enhancement": [17,32,48, 6,29,41, 12,20,44], 
-        "Openness to change": [1,23,39, 16,30,56, 10,28,43, 3,36,46], 
-        "Conservation": [13,26,53, 2,35,50, 18,33,40, 15,31,42, 4,22,51], 
-    }
-
     for response in responses:
         question_number = response['question_number']
         response_parsed = response['response_parsed']
-        for value, question_number_list in values_mapping_10.items():
+        for value, question_number_list in VALUES_MAPPING_10.items():
             if question_number in question_number_list:
                 scores_10[value].append(response_parsed)
-        for value, question_number_list in values_mapping_higher_order.items():
+        for value, question_number_list in VALUES_MAPPING_HIGHER_ORDER.items():
             if question_number in question_number_list:
                 higher_order[value].append(response_parsed)
 
@@ -123,7 +141,7 @@ def round_nested_dict(d, precision=4):
             d[key] = round(float(value), precision)
     return d
 
-def generate_report(file_paths):
+def generate_report(file_paths, persona, model):
     
     stats_10, stats_higher_order = aggregate_statistics(file_paths)
     round_nested_dict(stats_10)
@@ -217,16 +235,17 @@ def generate_report(file_paths):
         file.write('</div>')
         file.write('</body></html>')
 
-# Example usage with multiple files
-models = ['gpt-3.5-turbo-0125', 'anthropic.claude-3-sonnet-20240229-v1:0', 'command-r-plus']
-seeds = [1, 11, 21]
-personas = [5, 25, 50]
-for model in models:
-    for persona in personas:
-        file_paths = []
-        for seed in seeds:
-            file_paths.append(
-                f"runs/run_{persona}_{seed}_{model}/prompts-response.jsonl"
-            )
-        generate_report(file_paths)
+if __name__ == "__main__":
+    # Example usage with multiple files
+    models = ['gpt-3.5-turbo-0125', 'anthropic.claude-3-sonnet-20240229-v1:0', 'command-r-plus']
+    seeds = [1, 11, 21]
+    personas = [5, 25, 50]
+    for model in models:
+        for persona in personas:
+            file_paths = []
+            for seed in seeds:
+                file_paths.append(
+                    f"runs/run_{persona}_{seed}_{model}/prompts-response.jsonl"
+                )
+            generate_report(file_paths, persona, model)
 
@@ -0,0 +1,139 @@
+import argparse
+import asyncio
+import io
+import json
+import os
+from collections import defaultdict
+from rich.console import Console
+from rich.markdown import Markdown
+from rich.progress import Progress
+from rich.traceback import install
+from api_keys import set_api_keys
+set_api_keys()
+from models import MODELS, BaseModel, add_model_arguments, configure_models
+from ask import set_experiment_parameters, load_questions, PromptStream, collect_responses, sibling_runs, run_suffix
+from resume import load_reusable, persona_question_key, add_reuse_arguments
+from persona import generate_personas, add_persona_arguments, PERSONA_YEAR
+from limits import set_concurrency
+from cache import add_cache_arguments
+from console_log import ConsoleLog, add_log_arguments
+from runfile import add_output_arguments, output_options
+from replay import add_backend_arguments, install_backend
+from score import parse_responses, compute_scores, generate_report
+import extract
+import metrics
+
+# Runs a personas x seeds x models grid in one process. Every cell is a job
+# that writes the usual runs/run_{p}_{seed}_{model}/ directory and is scored
+# as soon as it completes; a report is generated once all seeds of a
+# (persona count, model) pair are done. All cells are in flight together, so
+# each provider works through its share under its own concurrency limit and
+# the grid takes as long as its slowest provider.
+
+def build_cells(models, personas, seeds, reuse = True, cache_layout = False, sampler = 'legacy', year = PERSONA_YEAR):
+    """One job per grid cell, with the prompts of a (persona count, seed) pair shared by all models."""
+    quiet = Console(file=io.StringIO())
+    questions = load_questions()
+    cells = []
+    for seed in seeds:
+        for personas_per_question in personas:
+            prompts = None
+            for model in models:
+                # Seeds the persona generator exactly as ask.py does
+                dir_path, jsonl_path, html_path = set_experiment_parameters(personas_per_question, seed, model, quiet, sampler=sampler)
+                if prompts is None:
+                    prompts = PromptStream(questions, generate_personas(personas_per_question, seed, sampler, year), cache_layout)
+                # Read before any cell starts, since the sweep rewrites these files
+                reusable = load_reusable(sibling_runs(personas_per_question, seed, model, sampler=sampler), persona_question_key, model.streams()) if reuse else None
+                cells.append({
+                    'personas': personas_per_question, 'seed': seed, 'model': model,
+                    'dir': dir_path, 'jsonl': jsonl_path, 'html': html_path, 'prompts': prompts, 'reusable': reusable, 'suffix': run_suffix(sampler),
+                    })
+    return cells
+
+def count_requests(cells):
+    # Cells with the same model and seed share a persona prefix, so many of their prompts are identical;
+    # each model keeps its responses for the whole sweep, so it asks every distinct prompt once.
+    # A prompt is set by its persona and question, so counting personas avoids rendering any prompt.
+    total = sum(len(cell['prompts']) for cell in cells)
+    personas = defaultdict(set)
+    for cell in cells:
+        personas[cell['model'].model].update(json.dumps(persona, sort_keys=True) for persona in cell['prompts'].personas)
+    questions = len(cells[0]['prompts'].questions) if cells else 0
+    unique = sum(len(distinct) for distinct in personas.values()) * questions
+    return total, unique
+
+def score_cell(cell, console):
+    """Write the value scores of a completed cell next to its responses."""
+    responses, mrat = parse_responses(cell['jsonl'])
+    scores_10, higher_order = compute_scores(responses, mrat)
+    with open(os.path.join(cell['dir'], 'scores.json'), 'w') as file:
+        json.dump({'mrat': mrat, 'scores_10': scores_10, 'higher_order': higher_order}, file, indent=2)
+    top = max(higher_order, key=higher_order.get)
+    console.print(f"Scored {os.path.basename(os.path.normpath(cell['dir']))}: MRAT {mrat:.3f}, highest higher-order value {top}")
+
+async def run_sweep(cells, console, concurrency, resume, log_options, report, output = None):
+    groups = {}
+    for cell in cells:
+        # Reports of other persona samplers are kept apart like their runs
+        groups.setdefault((cell['personas'], cell['model'].model + cell['suffix']), []).append(cell)
+    remaining = {group: len(members) for group, members in groups.items()}
+
+    async def run_cell(cell, progress):
+        cell_console = Console(record=True, file=io.StringIO())
+        log = ConsoleLog(cell_console, cell['html'], **log_options)
+        await collect_responses(cell['model'], cell['jsonl'], cell_console, log, progress, cell['prompts'], concurrency, resume, cell['reusable'], output)
+        score_cell(cell, progress.console)
+        group = (cell['personas'], cell['model'].model + cell['suffix'])
+        remaining[group] -= 1
+        if report and remaining[group] == 0:
+            generate_report([member['jsonl'] for member in groups[group]], *group)
+            progress.console.print(f"Report written for {group[1]} with {group[0]} personas")
+
+    with Progress(console=console, transient=True) as progress:
+        await asyncio.gather(*[run_cell(cell, progress) for cell in cells])
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Run a personas x seeds x models grid of experiments in one process.')
+    parser.add_argument('-m', '--models', type=str, nargs='+', default=['ChatGPT', 'Claude3Sonnet', 'CommandRPlus'], choices=list(MODELS), help='Models to ask')
+    parser.add_argument('-p', '--personas', type=int, nargs='+', default=[5, 25, 50], help='Persona counts per question')
+    parser.add_argument('-s', '--seeds', type=int, nargs='+', default=[1, 11, 21], help='Seeds')
+    parser.add_argument('-c', '--concurrency', type=int, default=8, help='Maximum requests in flight per provider')
+    parser.add_argument('-r', '--resume', action='store_true', help='Continue an interrupted sweep instead of starting over')
+    parser.add_argument('--no_reports', action='store_true', help='Only score the cells, without generating the HTML reports')
+    add_model_arguments(parser)
+    add_persona_arguments(parser)
+    add_reuse_arguments(parser)
+    add_cache_arguments(parser)
+    extract.add_extract_arguments(parser)
+    add_backend_arguments(parser)
+    add_log_arguments(parser)
+    add_output_arguments(parser)
+    return parser.parse_args()
+
+def main():
+    install()
+    console = Console(record=True)
+    args = parse_arguments()
+    install_backend(args)
+    models = [MODELS[name]() for name in dict.fromkeys(args.models)]
+    configure_models(models, args)
+    for model in models:
+        # Cells share prompts, so each one is asked once for the whole sweep
+        model.keep_responses = True
+    set_concurrency(args.concurrency)
+
+    cells = build_cells(models, sorted(set(args.personas)), sorted(set(args.seeds)), not args.no_reuse, args.prompt_caching, args.persona_sampler, args.persona_year)
+    total, unique = count_requests(cells)
+    console.print(
+        Markdown(f"""# SWEEP \n 1. *MODELS*: {', '.join(model.model for model in models)} \n 2. *PERSONAS*: {sorted(set(args.personas))} \n 3. *SEEDS*: {sorted(set(args.seeds))} \n 4. *RESPONSE PARSER*: {BaseModel().judge_model} \n 5. *REQUESTS*: {total} across {len(cells)} cells, {unique} unique""")
+        )
+    if not args.no_reports:
+        os.makedirs('reports', exist_ok=True)
+    log_options = {'interval': args.log_interval, 'every': args.log_every, 'max_bytes': int(args.log_max_mb * 2 ** 20)}
+    asyncio.run(run_sweep(cells, console, args.concurrency, args.resume, log_options, not args.no_reports, output_options(args)))
+    console.print(extract.summary())
+    console.print(metrics.usage_summary())
+
+if __name__ == "__main__":
+    main()